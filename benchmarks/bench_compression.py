@@ -0,0 +1,107 @@
+"""Archive build time and size for a representative mix of blobs.
+
+Compares writing every member deflated in the exporting thread, as the
+export script used to, with the compression policy of ArchiveWriter:
+already compressed types are stored, and large members are compressed in
+a thread pool.
+
+    $ python benchmarks/bench_compression.py [--scale N]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+from zopestubs import load_script
+
+export = load_script('export_bika_setup')
+
+# (content type, size in bytes, number of files, compressible)
+blob_mix = [
+    ('image/png', 60 * 1024, 200, False),
+    ('image/jpeg', 400 * 1024, 50, False),
+    ('application/pdf', 4 * 1024 * 1024, 20, False),
+    ('text/plain', 150 * 1024, 100, True),
+    ('text/csv', 3 * 1024 * 1024, 10, True),
+    ('application/octet-stream', 2 * 1024 * 1024, 10, True),
+]
+
+
+def make_blobs(directory, scale):
+    """Write the blob mix into directory, and return [(path, content type)].
+    Incompressible data is random; compressible data is repetitive text.
+    """
+    words = ' '.join('sample%d result %d.%02d mg/L' % (i, i % 97, i % 89)
+                     for i in range(2000)) + '\n'
+    blobs = []
+    for content_type, size, count, compressible in blob_mix:
+        for nr in range(int(count * scale) or 1):
+            path = os.path.join(directory, '%s-%d' % (
+                content_type.replace('/', '-'), nr))
+            with open(path, 'wb') as fp:
+                if compressible:
+                    data = words * (size // len(words) + 1)
+                    fp.write(data[:size])
+                else:
+                    fp.write(os.urandom(size))
+            blobs.append((path, content_type))
+    return blobs
+
+
+def build_serial(filename, blobs, level):
+    zf = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED,
+                         allowZip64=True)
+    for path, content_type in blobs:
+        export.write_zip_member(
+            zf, os.path.basename(path), export.iter_file(open(path, 'rb')),
+            size=os.path.getsize(path), level=level)
+    zf.close()
+
+
+def build_policy(filename, blobs, level, threads):
+    archive = export.ArchiveWriter(filename, level=level, threads=threads)
+    for path, content_type in blobs:
+        archive.write(
+            os.path.basename(path), export.iter_file(open(path, 'rb')),
+            size=os.path.getsize(path), content_type=content_type,
+            path=path)
+    archive.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the number of files by this')
+    parser.add_argument('--level', type=int, default=6)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        blobs = make_blobs(tempdir, args.scale)
+        total = sum(os.path.getsize(path) for path, ct in blobs)
+        print '%d blobs, %.1f MB' % (len(blobs), total / 1e6)
+        print '%-32s %10s %10s' % ('mode', 'seconds', 'MB')
+        runs = [
+            ('deflate all, serial', build_serial, (args.level,)),
+            ('policy, no threads', build_policy, (args.level, 0)),
+            ('policy, %d threads' % args.threads, build_policy,
+             (args.level, args.threads)),
+        ]
+        for label, build, extra in runs:
+            filename = os.path.join(tempdir, 'archive.zip')
+            start = time.time()
+            build(filename, blobs, *extra)
+            elapsed = time.time() - start
+            assert zipfile.ZipFile(filename).testzip() is None
+            print '%-32s %10.2f %10.1f' % (
+                label, elapsed, os.path.getsize(filename) / 1e6)
+            os.remove(filename)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
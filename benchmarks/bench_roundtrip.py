@@ -0,0 +1,162 @@
+"""Export and import round trip through a stand-in bika site.
+
+A site is populated with generated content (see fakesite.py), exported
+with export_bika_setup.py, and imported into an empty site with
+import_bika_setup.py.  Each phase runs in its own process, and reports
+its time, objects per second and peak memory; the archive size and the
+number of objects that arrived are reported too.
+
+    $ python benchmarks/bench_roundtrip.py [--scale N] [--count TYPE=N]
+        [--format jsonl] [--export-args ARGS] [--import-args ARGS]
+        [--report FILE]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+
+import fakesite
+import zopestubs
+
+
+def peak_rss():
+    """Return the peak resident set size of this process, in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_export(args, counts, tempdir, archive, results):
+    app = fakesite.App()
+    site = app.add_site()
+    blob_dir = os.path.join(tempdir, 'blobs')
+    os.mkdir(blob_dir)
+    start = time.time()
+    created = fakesite.populate(site, counts, blob_dir, args.blob_size)
+    generate = time.time() - start
+    rss_before = peak_rss()
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    zopestubs.run_script(
+        'export_bika_setup',
+        ['-s', 'Plone', '-o', archive, '-f', args.format] +
+        shlex.split(args.export_args), app)
+    results.put({
+        'generate_seconds': generate,
+        'seconds': time.time() - start,
+        'objects': sum(created.values()),
+        'counts': created,
+        'rss_before_mb': rss_before,
+        'peak_rss_mb': peak_rss(),
+    })
+
+
+def run_import(args, archive, results):
+    app = fakesite.App()
+    site = app.add_site()
+    rss_before = peak_rss()
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    start = time.time()
+    zopestubs.run_script(
+        'import_bika_setup',
+        ['-s', 'Plone', '-i', archive] + shlex.split(args.import_args), app)
+    counts = site.count()
+    results.put({
+        'seconds': time.time() - start,
+        'objects': sum(counts.values()),
+        'counts': counts,
+        'rss_before_mb': rss_before,
+        'peak_rss_mb': peak_rss(),
+    })
+
+
+def run_phase(target, *args):
+    """Run target(*args, results) in a child process, and return what it
+    put on results.
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=args + (results,))
+    process.start()
+    process.join()
+    if process.exitcode:
+        raise RuntimeError('%s failed' % target.__name__)
+    return results.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the number of objects by this')
+    parser.add_argument('--count', action='append', default=[],
+                        metavar='TYPE=N',
+                        help='number of objects of TYPE to create, instead'
+                             ' of the scaled default; may be repeated')
+    parser.add_argument('--blob-size', type=int, default=20000,
+                        help='size of each generated file, in bytes')
+    parser.add_argument('--format', default='xlsx',
+                        choices=['xlsx', 'jsonl'])
+    parser.add_argument('--export-args', default='',
+                        help='more options for export_bika_setup.py')
+    parser.add_argument('--import-args', default='',
+                        help='more options for import_bika_setup.py')
+    parser.add_argument('--report', default='',
+                        help='also write the results to this JSON file')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show the output of the scripts')
+    args = parser.parse_args()
+
+    counts = dict((portal_type, int(count * args.scale))
+                  for portal_type, count in fakesite.default_counts.items())
+    for item in args.count:
+        portal_type, _, count = item.partition('=')
+        if portal_type not in fakesite.site_types:
+            parser.error('%s is not one of %s' % (
+                portal_type, ', '.join(fakesite.site_types)))
+        counts[portal_type] = int(count)
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        archive = os.path.join(tempdir, 'archive.zip')
+        export = run_phase(run_export, args, counts, tempdir, archive)
+        archive_size = os.path.getsize(archive)
+        imported = run_phase(run_import, args, archive)
+    finally:
+        shutil.rmtree(tempdir)
+
+    print '%d objects, %s format, archive %.1f MB' % (
+        export['objects'], args.format, archive_size / 1e6)
+    print '%-8s %10s %12s %14s' % ('phase', 'seconds', 'objects/s',
+                                   'peak RSS MB')
+    for label, phase in (('export', export), ('import', imported)):
+        phase['objects_per_second'] = \
+            phase['objects'] / phase['seconds'] if phase['seconds'] else 0
+        print '%-8s %10.2f %12.0f %14.1f' % (
+            label, phase['seconds'], phase['objects_per_second'],
+            phase['peak_rss_mb'])
+    missing = dict((portal_type, count - imported['counts'][portal_type])
+                   for portal_type, count in export['counts'].items()
+                   if imported['counts'][portal_type] != count)
+    if missing:
+        print 'Objects missing after import: %s' % missing
+    if args.report:
+        with open(args.report, 'w') as fp:
+            json.dump({
+                'format': args.format,
+                'export_args': args.export_args,
+                'import_args': args.import_args,
+                'archive_bytes': archive_size,
+                'export': export,
+                'import': imported,
+                'missing': missing,
+            }, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
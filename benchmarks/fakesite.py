@@ -0,0 +1,804 @@
+"""A stand-in bika site, for running the export and import scripts
+without Plone or a database.
+
+Content, fields, schemas, catalogs and tools here implement only the parts
+of the Archetypes and CMF API that the scripts use.  populate() fills a
+site with objects of some of the export_types, with single and multiple
+references, records, lines, dates and blob-backed files.
+"""
+from collections import OrderedDict
+from email.utils import formatdate
+
+import os
+import random
+import uuid
+
+import zopestubs
+
+zopestubs.install()
+
+from Products.ATExtensions.ateapi import RecordField, RecordsField  # noqa
+from Products.Archetypes.CatalogMultiplex import CatalogMultiplex  # noqa
+
+_marker = object()
+
+
+class Field(object):
+    """A field that keeps its value in the instance's _values.
+    """
+    __provides__ = ()
+    type = 'string'
+    default = ''
+    multiValued = False
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.__dict__.update(kwargs)
+
+    def getName(self):
+        return self.name
+
+    def get(self, instance):
+        return instance._values.get(self.name, self.default)
+
+    def getRaw(self, instance, aslist=False):
+        return self.get(instance)
+
+    def set(self, instance, value, **kwargs):
+        instance._values[self.name] = value
+
+
+class IdField(Field):
+
+    def get(self, instance):
+        return instance.id
+
+    def set(self, instance, value, **kwargs):
+        instance.id = value
+
+
+class TextField(Field):
+    __provides__ = ('ITextField', 'IFileField')
+    type = 'text'
+
+
+class LinesField(Field):
+    __provides__ = ('ILinesField',)
+    type = 'lines'
+    default = ()
+
+    def set(self, instance, value, **kwargs):
+        instance._values[self.name] = tuple(value or ())
+
+
+class DateTimeField(Field):
+    __provides__ = ('IDateTimeField',)
+    type = 'datetime'
+    default = None
+
+
+class FileField(Field):
+    __provides__ = ('IFileField',)
+    type = 'file'
+    default = None
+
+    def set(self, instance, value, filename=None, mimetype=None, **kwargs):
+        if not value:
+            instance._values[self.name] = None
+            return
+        # Imported files are read, but only their size is kept
+        size = 0
+        while True:
+            buf = value.read(1 << 16)
+            if not buf:
+                break
+            size += len(buf)
+        value.close()
+        instance._values[self.name] = File(None, size, mimetype, filename)
+
+
+class ReferenceField(Field):
+    """A reference field, which stores UIDs and returns the objects.
+    """
+    __provides__ = ('IReferenceField',)
+    type = 'reference'
+    default = None
+    allowed_types = ()
+    relationship = ''
+
+    def get(self, instance):
+        value = instance._values.get(self.name)
+        uids = instance._site.uids
+        if self.multiValued:
+            return [uids[uid] for uid in value or () if uid in uids]
+        return uids.get(value)
+
+    def getRaw(self, instance, aslist=False):
+        value = instance._values.get(self.name)
+        if self.multiValued or aslist:
+            return list(value or ())
+        return value
+
+    def set(self, instance, value, **kwargs):
+        if self.multiValued and isinstance(value, basestring):
+            value = [value]
+        instance._values[self.name] = value
+
+
+class FakeRecordField(RecordField, Field):
+    type = 'record'
+    default = {}
+
+
+class FakeRecordsField(RecordsField, Field):
+    type = 'records'
+    default = []
+
+
+class Schema(object):
+
+    def __init__(self, fields):
+        self._fields = OrderedDict(
+            (field.getName(), field) for field in fields)
+
+    def fields(self):
+        return self._fields.values()
+
+    def __getitem__(self, name):
+        return self._fields[name]
+
+    def get(self, name, default=None):
+        return self._fields.get(name, default)
+
+
+class Date(object):
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+
+    def rfc822(self):
+        return formatdate(self.timestamp)
+
+
+class Blob(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def open(self, mode='r'):
+        return open(self.path, 'rb')
+
+    def committed(self):
+        return self.path
+
+
+class File(object):
+    """A File field value; blob-backed if it has a path.
+    """
+
+    def __init__(self, path, size, content_type, filename):
+        self.path = path
+        self.size = size
+        self.content_type = content_type
+        self.filename = filename
+
+    def getBlob(self):
+        return Blob(self.path)
+
+
+class Traversable(object):
+
+    def _getOb(self, id, default=None):
+        return self._objects.get(id, default)
+
+    def __getitem__(self, id):
+        return self._objects[id]
+
+    def unrestrictedTraverse(self, path, default=_marker):
+        if isinstance(path, basestring):
+            path = path.split('/')
+        path = list(path)
+        obj = self
+        if path and path[0] == '':
+            # absolute paths start at the application root
+            obj = self.getPhysicalRoot()
+        for name in path:
+            if not name:
+                continue
+            obj = obj._getOb(name)
+            if obj is None:
+                if default is not _marker:
+                    return default
+                raise KeyError(name)
+        return obj
+
+    def manage_delObjects(self, ids):
+        for id in ids:
+            obj = self._objects.pop(id)
+            for child in obj.walk():
+                self._site.uncatalog(child)
+
+    def walk(self):
+        """Yield this object's content, and all content below it.
+        """
+        if isinstance(self, Content):
+            yield self
+        for obj in self._objects.values():
+            for child in obj.walk():
+                yield child
+
+
+class Folder(Traversable):
+    """A container which is not itself cataloged or exported.
+    """
+
+    def __init__(self, site, id, parent):
+        self._site = site
+        self.id = id
+        self._parent = parent
+        self._objects = OrderedDict()
+
+    def getPhysicalPath(self):
+        return self._parent.getPhysicalPath() + (self.id,)
+
+    def getPhysicalRoot(self):
+        return self._parent.getPhysicalRoot()
+
+
+class Content(Folder, CatalogMultiplex):
+
+    def __init__(self, site, portal_type, id, parent):
+        Folder.__init__(self, site, id, parent)
+        self.portal_type = portal_type
+        self.schema = site.schemas[portal_type]
+        self._values = {}
+        self._uid = uuid.uuid4().hex
+        site.uids[self._uid] = self
+
+    def UID(self):
+        return self._uid
+
+    def getId(self):
+        return self.id
+
+    def Title(self):
+        return self._values.get('title', '')
+
+    def setTitle(self, title):
+        self._values['title'] = title
+
+    def unmarkCreationFlag(self):
+        pass
+
+    def _p_deactivate(self):
+        pass
+
+    def getCatalogs(self):
+        return self._site.archetype_tool.getCatalogsByType(self.portal_type)
+
+
+class Brain(object):
+
+    def __init__(self, obj, path, rid):
+        self._obj = obj
+        self._path = path
+        self._rid = rid
+        self.id = self.getId = obj.id
+        self.UID = obj.UID()
+        self.portal_type = obj.portal_type
+
+    def getObject(self):
+        return self._obj
+
+    def getPath(self):
+        return self._path
+
+    def getRID(self):
+        return self._rid
+
+
+class Catalog(object):
+    """A catalog which answers portal_type, UID and path queries by
+    scanning its brains.  nr_queries counts the queries made.
+    """
+
+    def __init__(self, site, id):
+        self._site = site
+        self.id = id
+        self._brains = OrderedDict()
+        # {path: rid}, and {rid: brain}
+        self._paths = {}
+        self._rids = {}
+        self._last_rid = 0
+        self.nr_queries = 0
+
+    def indexes(self):
+        return ['id', 'path', 'portal_type', 'UID']
+
+    def catalog_object(self, obj, uid=None):
+        path = uid or '/'.join(obj.getPhysicalPath())
+        if path not in self._paths:
+            self._last_rid += 1
+            self._paths[path] = self._last_rid
+        rid = self._paths[path]
+        self._brains[path] = self._rids[rid] = Brain(obj, path, rid)
+
+    def uncatalog_object(self, path):
+        self._brains.pop(path, None)
+        rid = self._paths.pop(path, None)
+        self._rids.pop(rid, None)
+
+    def getpath(self, rid):
+        return self._rids[rid].getPath()
+
+    def getobject(self, rid):
+        return self._rids[rid].getObject()
+
+    def __call__(self, portal_type=None, sort_on=None, UID=None, path=None,
+                 **query):
+        self.nr_queries += 1
+        brains = [brain for brain in self._brains.values()
+                  if portal_type is None or brain.portal_type == portal_type]
+        if UID is not None:
+            uids = set([UID] if isinstance(UID, basestring) else UID)
+            brains = [brain for brain in brains if brain.UID in uids]
+        if path is not None:
+            paths = path['query'] if isinstance(path, dict) else path
+            if isinstance(paths, basestring):
+                paths = [paths]
+            brains = [brain for brain in brains
+                      if any(brain.getPath() == prefix
+                             or brain.getPath().startswith(prefix + '/')
+                             for prefix in paths)]
+        if sort_on:
+            brains.sort(key=lambda brain: getattr(brain, sort_on))
+        return brains
+
+    searchResults = __call__
+
+    def clearFindAndRebuild(self):
+        self._brains.clear()
+        self._rids.clear()
+        for obj in self._site.walk():
+            if self in obj.getCatalogs():
+                self.catalog_object(obj)
+
+
+class ArchetypeTool(object):
+
+    def __init__(self, site):
+        self._site = site
+
+    def getCatalogsByType(self, portal_type):
+        name = self._site.types.get(portal_type, {}).get(
+            'catalog', 'portal_catalog')
+        return [self._site.catalogs[name]]
+
+    def listRegisteredTypes(self):
+        return [{'portal_type': portal_type, 'schema': schema}
+                for portal_type, schema in self._site.schemas.items()]
+
+
+class TypeInfo(object):
+
+    def __init__(self, site, portal_type, allowed_content_types):
+        self._site = site
+        self.portal_type = portal_type
+        self.allowed_content_types = allowed_content_types
+
+    def constructInstance(self, container, id, title=''):
+        obj = Content(self._site, self.portal_type, id, container)
+        container._objects[id] = obj
+        obj.setTitle(title)
+        obj.indexObject()
+        return obj
+
+
+class TypesTool(object):
+
+    def __init__(self, site):
+        self._site = site
+        self.infos = {}
+        for portal_type in site.types:
+            allowed = [child for child, info in site.types.items()
+                       if info.get('parent') == portal_type]
+            self.infos[portal_type] = TypeInfo(site, portal_type, allowed)
+
+    def __contains__(self, portal_type):
+        return portal_type in self.infos
+
+    def __getitem__(self, portal_type):
+        return self.infos[portal_type]
+
+
+class ReferenceCatalog(object):
+
+    def __init__(self, site):
+        self._site = site
+
+    def lookupObject(self, uid):
+        return self._site.uids.get(uid)
+
+
+class MimetypesRegistry(object):
+    extensions = {
+        'pdf': 'application/pdf',
+        'png': 'image/png',
+        'txt': 'text/plain',
+    }
+
+
+class DB(object):
+
+    def lastTransaction(self):
+        return '\0' * 8
+
+
+class Connection(object):
+
+    def cacheMinimize(self):
+        pass
+
+    def sync(self):
+        pass
+
+    def db(self):
+        return DB()
+
+
+def setup_fields():
+    return [IdField('id'), Field('title'), Field('description')]
+
+
+# The types the site holds, in the order they are created: the folder
+# (relative to the site) or parent type they live in, the catalog they are
+# indexed in, and their fields besides setup_fields.  Departments and lab
+# contacts reference each other, so some references must be deferred.
+site_types = OrderedDict([
+    ('AnalysisCategory', {
+        'folder': 'bika_setup/bika_analysiscategories',
+        'catalog': 'bika_setup_catalog',
+        'fields': lambda: [TextField('Comments')]}),
+    ('Department', {
+        'folder': 'bika_setup/bika_departments',
+        'catalog': 'bika_setup_catalog',
+        'fields': lambda: [
+            ReferenceField('Manager', allowed_types=('LabContact',),
+                           relationship='DepartmentLabContact')]}),
+    ('LabContact', {
+        'folder': 'bika_setup/bika_labcontacts',
+        'catalog': 'bika_setup_catalog',
+        'fields': lambda: [
+            Field('Firstname'),
+            Field('Surname'),
+            FileField('Signature'),
+            ReferenceField('Departments', multiValued=True,
+                           allowed_types=('Department',),
+                           relationship='LabContactDepartment')]}),
+    ('Method', {
+        'folder': 'methods',
+        'catalog': 'bika_setup_catalog',
+        'fields': lambda: [
+            TextField('Instructions'), FileField('MethodDocument')]}),
+    ('SampleType', {
+        'folder': 'bika_setup/bika_sampletypes',
+        'catalog': 'bika_setup_catalog',
+        'fields': lambda: [
+            Field('Prefix'),
+            Field('Hazardous', default=False),
+            FakeRecordField('RetentionPeriod',
+                            subfields=('days', 'hours', 'minutes'))]}),
+    ('SamplePoint', {
+        'folder': 'bika_setup/bika_samplepoints',
+        'catalog': 'bika_setup_catalog',
+        'fields': lambda: [
+            Field('Composite', default=False),
+            DateTimeField('SamplingFrequency'),
+            ReferenceField('SampleTypes', multiValued=True,
+                           allowed_types=('SampleType',),
+                           relationship='SamplePointSampleType')]}),
+    ('AnalysisService', {
+        'folder': 'bika_setup/bika_analysisservices',
+        'catalog': 'bika_setup_catalog',
+        'fields': lambda: [
+            Field('Keyword'),
+            Field('Price'),
+            ReferenceField('Category', allowed_types=('AnalysisCategory',),
+                           relationship='AnalysisServiceAnalysisCategory'),
+            ReferenceField('Methods', multiValued=True,
+                           allowed_types=('Method',),
+                           relationship='AnalysisServiceMethods'),
+            FakeRecordsField('ResultOptions',
+                             subfields=('ResultValue', 'ResultText'))]}),
+    ('AnalysisSpec', {
+        'folder': 'bika_setup/bika_analysisspecs',
+        'catalog': 'bika_setup_catalog',
+        'fields': lambda: [
+            # Another RecordsField, with other keys than ResultOptions
+            FakeRecordsField('ResultsRange',
+                             subfields=('keyword', 'min', 'max'))]}),
+    ('Supplier', {
+        'folder': 'bika_setup/bika_suppliers',
+        'catalog': 'bika_setup_catalog',
+        'fields': lambda: [Field('Name'), Field('TaxNumber')]}),
+    ('SupplierContact', {
+        'parent': 'Supplier',
+        'catalog': 'bika_setup_catalog',
+        'fields': lambda: [Field('Firstname'), Field('Surname')]}),
+    ('Client', {
+        'folder': 'clients',
+        'catalog': 'portal_catalog',
+        'fields': lambda: [
+            Field('ClientID'),
+            Field('EmailAddress'),
+            LinesField('CCEmails'),
+            ReferenceField('DefaultCategories', multiValued=True,
+                           allowed_types=('AnalysisCategory',),
+                           relationship='ClientDefaultCategories'),
+            # Contacts are contained in clients; this reference runs
+            # against the containment.
+            ReferenceField('DefaultContact', allowed_types=('Contact',),
+                           relationship='ClientDefaultContact')]}),
+    ('Contact', {
+        'parent': 'Client',
+        'catalog': 'portal_catalog',
+        'fields': lambda: [
+            Field('Firstname'), Field('Surname'), Field('EmailAddress'),
+            LinesField('CCContact')]}),
+])
+
+# Number of objects of each type that populate() creates at scale 1
+default_counts = OrderedDict([
+    ('AnalysisCategory', 50),
+    ('Department', 20),
+    ('LabContact', 100),
+    ('Method', 100),
+    ('SampleType', 200),
+    ('SamplePoint', 500),
+    ('AnalysisService', 2000),
+    ('AnalysisSpec', 100),
+    ('Supplier', 50),
+    ('SupplierContact', 500),
+    ('Client', 500),
+    ('Contact', 5000),
+])
+
+
+class Site(Traversable):
+    """A bika site, with bika_setup, its laboratory, the catalogs and tools
+    the scripts use, and a folder for every type in site_types.
+    """
+
+    def __init__(self, app, id='Plone'):
+        self._app = app
+        self._site = self
+        self.id = id
+        self._objects = OrderedDict()
+        self._p_jar = Connection()
+        self.uids = {}
+        self.types = site_types
+        self.schemas = OrderedDict(
+            (portal_type, Schema(setup_fields() + info['fields']()))
+            for portal_type, info in site_types.items())
+        self.schemas['BikaSetup'] = Schema(
+            setup_fields() + [Field('DefaultSampleLifetime'),
+                              Field('AutoPrintStickers')])
+        self.schemas['Laboratory'] = Schema(
+            setup_fields() + [Field('Name'), Field('TaxNumber'),
+                              Field('LabURL')])
+        self.catalogs = dict((name, Catalog(self, name)) for name in (
+            'bika_analysis_catalog', 'bika_catalog', 'bika_setup_catalog',
+            'portal_catalog'))
+        self.archetype_tool = ArchetypeTool(self)
+        self.portal_types = TypesTool(self)
+        self.reference_catalog = ReferenceCatalog(self)
+        self.mimetypes_registry = MimetypesRegistry()
+        self.bika_setup = Content(self, 'BikaSetup', 'bika_setup', self)
+        self._objects['bika_setup'] = self.bika_setup
+        self.bika_setup.laboratory = Content(
+            self, 'Laboratory', 'laboratory', self.bika_setup)
+        self.bika_setup._objects['laboratory'] = self.bika_setup.laboratory
+        for info in site_types.values():
+            if 'folder' in info:
+                self.get_folder(info['folder'])
+
+    def __getitem__(self, name):
+        if name in self.catalogs:
+            return self.catalogs[name]
+        return self._objects[name]
+
+    def getPhysicalPath(self):
+        return ('', self.id)
+
+    def getPhysicalRoot(self):
+        return self._app
+
+    def get_folder(self, path):
+        folder = self
+        for name in path.split('/'):
+            if name not in folder._objects:
+                folder._objects[name] = Folder(self, name, folder)
+            folder = folder._objects[name]
+        return folder
+
+    def uncatalog(self, obj):
+        path = '/'.join(obj.getPhysicalPath())
+        for catalog in obj.getCatalogs():
+            catalog.uncatalog_object(path)
+        self.uids.pop(obj.UID(), None)
+
+    def walk(self):
+        # bika_setup and the laboratory are not content of any site_types
+        for obj in Traversable.walk(self):
+            if obj.portal_type in site_types:
+                yield obj
+
+    def count(self):
+        """Return {portal_type: number of objects} for the site's content.
+        """
+        counts = dict((portal_type, 0) for portal_type in site_types)
+        for obj in self.walk():
+            counts[obj.portal_type] += 1
+        return counts
+
+
+class AclUsers(object):
+
+    def getUserById(self, user_id):
+        return user_id
+
+
+class App(Traversable):
+    """The Zope application root, holding the sites.
+    """
+
+    def __init__(self):
+        self._objects = OrderedDict()
+        self.acl_users = AclUsers()
+
+    def getPhysicalPath(self):
+        return ('',)
+
+    def getPhysicalRoot(self):
+        return self
+
+    def add_site(self, id='Plone'):
+        self._objects[id] = Site(self, id)
+        return self._objects[id]
+
+
+def make_blob(directory, nr, size, content_type):
+    """Write the data of the nr'th blob, and return its File.  Images are
+    random data, anything else is text.
+    """
+    if content_type.startswith('image/'):
+        data = os.urandom(size)
+    else:
+        line = 'sample %d result %d mg/L\n' % (nr, nr % 97)
+        data = (line * (size // len(line) + 1))[:size]
+    ext = {'image/png': 'png', 'text/plain': 'txt'}.get(content_type, 'bin')
+    path = os.path.join(directory, 'blob-%d.%s' % (nr, ext))
+    with open(path, 'wb') as fp:
+        fp.write(data)
+    return File(path, size, content_type, os.path.basename(path))
+
+
+def populate(site, counts, blob_dir, blob_size=20000, seed=0):
+    """Create counts[portal_type] objects of each type in site_types, with
+    field values that are generated from seed.  Blobs are written into
+    blob_dir; one file in five is shared with another object.
+    """
+    rand = random.Random(seed)
+    created = dict((portal_type, []) for portal_type in site_types)
+    pt = site.portal_types
+
+    def pick(portal_type, n=None):
+        objects = created[portal_type]
+        if not objects:
+            return [] if n else None
+        if n:
+            return [obj.UID() for obj in rand.sample(
+                objects, min(n, len(objects)))]
+        return rand.choice(objects).UID()
+
+    blobs = []
+    pending = []
+    site.bika_setup._values.update(
+        title='Bika Setup', DefaultSampleLifetime='30',
+        AutoPrintStickers='receive')
+    site.bika_setup.laboratory._values.update(
+        title='Laboratory', Name='Benchmark Laboratory',
+        TaxNumber='123', LabURL='http://example.com')
+    def attach(content_type):
+        # Some files are shared between objects
+        if blobs and rand.random() < 0.2:
+            return rand.choice(blobs)
+        blobs.append(make_blob(blob_dir, len(blobs), blob_size,
+                               content_type))
+        return blobs[-1]
+
+    for portal_type, info in site_types.items():
+        prefix = portal_type.lower()
+        for nr in range(counts.get(portal_type, 0)):
+            if 'parent' in info:
+                parent = site.uids[pick(info['parent'])]
+            else:
+                parent = site.get_folder(info['folder'])
+            obj = pt[portal_type].constructInstance(
+                parent, '%s-%d' % (prefix, nr),
+                title='%s %d' % (portal_type, nr))
+            values = obj._values
+            values['description'] = 'Generated %s number %d' % (
+                portal_type, nr)
+            if portal_type == 'AnalysisCategory':
+                values['Comments'] = 'Category comments\n' * 3
+            elif portal_type == 'Department':
+                # Lab contacts are created later; the import must defer
+                # these references.
+                pending.append(obj)
+            elif portal_type == 'LabContact':
+                values['Firstname'] = 'First%d' % nr
+                values['Surname'] = 'Last%d' % nr
+                values['Signature'] = attach('image/png')
+                values['Departments'] = pick('Department', 2)
+            elif portal_type == 'Method':
+                values['Instructions'] = 'Step one.\nStep two.\n'
+                values['MethodDocument'] = attach('text/plain')
+            elif portal_type == 'SampleType':
+                values['Prefix'] = 'ST%d' % nr
+                values['Hazardous'] = bool(nr % 2)
+                values['RetentionPeriod'] = {
+                    'days': str(nr % 30), 'hours': '0', 'minutes': '0'}
+            elif portal_type == 'SamplePoint':
+                values['Composite'] = bool(nr % 3)
+                values['SamplingFrequency'] = Date(1.5e9 + nr * 3600)
+                values['SampleTypes'] = pick('SampleType', 3)
+            elif portal_type == 'AnalysisService':
+                values['Keyword'] = 'AS%d' % nr
+                values['Price'] = '%.2f' % (rand.random() * 100)
+                values['Category'] = pick('AnalysisCategory')
+                values['Methods'] = pick('Method', rand.randint(0, 2))
+                values['ResultOptions'] = [
+                    {'ResultValue': str(i), 'ResultText': 'Option %d' % i}
+                    for i in range(rand.randint(0, 3))]
+            elif portal_type == 'AnalysisSpec':
+                values['ResultsRange'] = [
+                    {'keyword': service.getId(), 'min': str(i),
+                     'max': str(i + 10)}
+                    for i, service in enumerate(rand.sample(
+                        created['AnalysisService'],
+                        min(3, len(created['AnalysisService']))))]
+                # Some ranges have optional keys, which are not subfields
+                for i, result_range in enumerate(values['ResultsRange']):
+                    if (nr + i) % 4 == 0:
+                        result_range['warn_min'] = str(i - 1)
+                    if (nr + i) % 5 == 0:
+                        result_range['hidemin'] = str(i)
+            elif portal_type == 'Supplier':
+                values['Name'] = 'Supplier %d' % nr
+                values['TaxNumber'] = 'TAX%d' % nr
+            elif portal_type == 'SupplierContact':
+                values['Firstname'] = 'First%d' % nr
+                values['Surname'] = 'Last%d' % nr
+            elif portal_type == 'Client':
+                values['ClientID'] = 'C%d' % nr
+                values['EmailAddress'] = 'client%d@example.com' % nr
+                # Every tenth client has no CC addresses: an empty lines
+                # value.
+                values['CCEmails'] = ('a%d@example.com' % nr,
+                                      'b%d@example.com' % nr) \
+                    if nr % 10 else ()
+                values['DefaultCategories'] = pick('AnalysisCategory', 3)
+            elif portal_type == 'Contact':
+                values['Firstname'] = 'First%d' % nr
+                values['Surname'] = 'Last%d' % nr
+                values['EmailAddress'] = 'contact%d@example.com' % nr
+                values['CCContact'] = ('cc%d@example.com' % nr,)
+                if not parent._values.get('DefaultContact'):
+                    parent._values['DefaultContact'] = obj.UID()
+            created[portal_type].append(obj)
+        if portal_type == 'LabContact':
+            for department in pending:
+                department._values['Manager'] = pick('LabContact')
+    return dict((portal_type, len(objects))
+                for portal_type, objects in created.items())
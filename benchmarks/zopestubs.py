@@ -0,0 +1,130 @@
+"""Load export_bika_setup.py and import_bika_setup.py outside of Zope.
+
+The scripts import a handful of Zope and Plone modules at the top, and
+expect to find `app` in their globals.  The stand-ins installed here only
+satisfy those imports, so that the scripts' helpers can be benchmarked;
+anything that really talks to a site must be given objects that behave
+like one (see fakesite.py).
+"""
+import __builtin__
+import imp
+import os
+import runpy
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Interface(object):
+    """Stand-in for a zope.interface interface: objects provide it if they
+    have its name in their __provides__ attribute.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def providedBy(self, obj):
+        return self.name in getattr(obj, '__provides__', ())
+
+
+class BlobError(Exception):
+    pass
+
+
+class CatalogMultiplex(object):
+    """Stand-in for the Archetypes mixin, which catalogs an object in the
+    catalogs returned by its getCatalogs().
+    """
+
+    def indexObject(self):
+        for catalog in self.getCatalogs():
+            catalog.catalog_object(self)
+
+    def reindexObject(self, idxs=[]):
+        self.indexObject()
+
+
+def module(name, **attrs):
+    if name in sys.modules:
+        mod = sys.modules[name]
+    else:
+        mod = sys.modules[name] = types.ModuleType(name)
+    for key, value in attrs.items():
+        setattr(mod, key, value)
+    # make the module an attribute of its package
+    if '.' in name:
+        package, _, child = name.rpartition('.')
+        setattr(module(package), child, mod)
+    return mod
+
+
+def install():
+    """Install stand-ins for the modules the scripts import, where the real
+    ones are not available.
+    """
+    def missing(name):
+        try:
+            __import__(name)
+        except ImportError:
+            return True
+        return False
+
+    field_interfaces = dict(
+        (name, Interface(name)) for name in (
+            'IComputedField', 'IDateTimeField', 'IFileField',
+            'ILinesField', 'IReferenceField', 'ITextField'))
+    stubs = {
+        'AccessControl.SecurityManagement': dict(
+            newSecurityManager=lambda request, user: None),
+        'Acquisition': dict(
+            aq_base=lambda obj: obj, aq_inner=lambda obj: obj,
+            aq_parent=lambda obj: getattr(obj, '_parent', None)),
+        'DateTime': dict(DateTime=lambda *args: args),
+        'Products.Archetypes.Field': field_interfaces,
+        'Products.Archetypes.CatalogMultiplex': dict(
+            CatalogMultiplex=CatalogMultiplex),
+        'Products.ATExtensions.ateapi': dict(
+            RecordField=type('RecordField', (object,), {}),
+            RecordsField=type('RecordsField', (object,), {})),
+        'Products.CMFCore.utils': dict(
+            getToolByName=lambda context, name: getattr(context, name)),
+        'Products.CMFPlone.factory': dict(
+            _DEFAULT_PROFILE='Products.CMFPlone:plone',
+            addPloneSite=lambda *args, **kwargs: None),
+        'ZODB.interfaces': dict(BlobError=BlobError),
+        'transaction': dict(
+            commit=lambda: None, abort=lambda: None,
+            savepoint=lambda optimistic=False: None),
+        'zope.annotation.interfaces': dict(
+            IAnnotations=lambda obj: obj.__dict__.setdefault(
+                '__annotations__', {})),
+        'zope.component.hooks': dict(setSite=lambda site: None),
+    }
+    for name, attrs in sorted(stubs.items()):
+        if missing(name):
+            module(name, **attrs)
+
+
+def load_script(name, app=None):
+    """Load one of the scripts (eg. 'export_bika_setup') as a module.
+    """
+    install()
+    __builtin__.app = app
+    try:
+        return imp.load_source(name, os.path.join(ROOT, name + '.py'))
+    finally:
+        del __builtin__.app
+
+
+def run_script(name, argv, app):
+    """Run one of the scripts as bin/instance run would, with command line
+    arguments argv and app as the Zope application root.
+    """
+    install()
+    __builtin__.app = app
+    sys.argv = [name + '.py'] + list(argv)
+    try:
+        runpy.run_path(os.path.join(ROOT, name + '.py'), run_name='__main__')
+    finally:
+        del __builtin__.app
@@ -1,13 +1,32 @@
 from AccessControl.SecurityManagement import newSecurityManager
+from Acquisition import aq_base
+from Acquisition import aq_inner
+from Acquisition import aq_parent
+from DateTime import DateTime
 from Products.Archetypes import Field
 from Products.CMFCore.utils import getToolByName
+from ZODB.interfaces import BlobError
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 import argparse
+import cProfile
+import hashlib
+import json
+import multiprocessing
 import openpyxl
 import os
+import Queue
+import resource
 import shutil
+import struct
+import sys
 import tempfile
+import time
+import traceback
 import zipfile
+import zlib
 
 
 # def excepthook(typ, value, tb):
@@ -101,10 +120,661 @@ ignore_fields = [
     'nextPreviousEnabled',
 ]
 
+# Content types (or prefixes of them) of data that is already compressed.
+# Members of these types are stored in the archive without deflating them.
+compressed_types = [
+    'application/pdf',
+    'application/zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-bzip2',
+    'application/x-7z-compressed',
+    'application/x-rar-compressed',
+    'application/vnd.openxmlformats-officedocument.',
+    'application/vnd.oasis.opendocument.',
+    'image/png',
+    'image/jpeg',
+    'image/gif',
+    'image/webp',
+    'audio/',
+    'video/',
+]
+
 app = app  # flake8: noqa
 
+# Size of the chunks in which file data is copied into the archive
+CHUNK_SIZE = 1 << 16
+# Column of a _values sheet which holds, as JSON, the keys of a dictionary
+# that the sheet has no columns for
+OTHER_KEYS = '_other'
+
+
+def iter_file(fp):
+    """Yield the contents of an open file in chunks, and close it.
+    """
+    try:
+        while True:
+            buf = fp.read(CHUNK_SIZE)
+            if not buf:
+                break
+            yield buf
+    finally:
+        fp.close()
+
+
+def iter_file_data(value):
+    """Yield the contents of a File or Image field value in chunks.
+
+    Blob-backed values are read from the blob file, OFS.Image values are read
+    by walking their Pdata chain, so the data is never loaded as a whole.
+    """
+    if hasattr(value, 'getBlob'):
+        for buf in iter_file(value.getBlob().open('r')):
+            yield buf
+        return
+    data = value.data
+    if isinstance(data, basestring):
+        for pos in range(0, len(data), CHUNK_SIZE):
+            yield data[pos:pos + CHUNK_SIZE]
+        return
+    while data is not None:
+        yield data.data
+        data = data.next
+
+
+def get_blob_path(value):
+    """Return the filename of the committed blob of a File or Image field
+    value, or None if it is not blob-backed.
+    """
+    if not hasattr(value, 'getBlob'):
+        return None
+    try:
+        return value.getBlob().committed()
+    except BlobError:
+        return None
+
+
+def iter_chunks(strings, size=CHUNK_SIZE):
+    """Join the strings yielded by strings into chunks of at least size
+    bytes, so that many small strings can be written efficiently.
+    """
+    buf = []
+    buf_size = 0
+    for string in strings:
+        buf.append(string)
+        buf_size += len(string)
+        if buf_size >= size:
+            yield ''.join(buf)
+            buf = []
+            buf_size = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def write_zip_member(zf, arcname, chunks, size=None,
+                     compress_type=zipfile.ZIP_DEFLATED,
+                     level=zlib.Z_DEFAULT_COMPRESSION):
+    """Write the strings yielded by chunks into zf as member arcname.
+
+    This does what ZipFile.write does for a file on disk, but reads from any
+    iterable, so members need not be staged on disk or held in memory.
+    size is used to decide if a zip64 header is needed; when it is not
+    known, a zip64 header is always written.
+    """
+    zinfo = zipfile.ZipInfo(arcname, time.localtime()[:6])
+    zinfo.external_attr = 0600 << 16L
+    zinfo.compress_type = compress_type
+    zinfo.flag_bits = 0x00
+    zinfo.header_offset = zf.fp.tell()
+    zinfo.file_size = size or 0
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    # Must overwrite CRC and sizes with correct data later
+    zinfo.CRC = crc = 0
+    zinfo.compress_size = compress_size = 0
+    zip64 = zf._allowZip64 and \
+        (size is None or size * 1.05 > zipfile.ZIP64_LIMIT)
+    zf.fp.write(zinfo.FileHeader(zip64))
+    if compress_type == zipfile.ZIP_DEFLATED:
+        cmpr = zlib.compressobj(level, zlib.DEFLATED, -15)
+    else:
+        cmpr = None
+    file_size = 0
+    for buf in chunks:
+        file_size += len(buf)
+        crc = zlib.crc32(buf, crc) & 0xffffffff
+        if cmpr:
+            buf = cmpr.compress(buf)
+            compress_size += len(buf)
+        zf.fp.write(buf)
+    if cmpr:
+        buf = cmpr.flush()
+        compress_size += len(buf)
+        zf.fp.write(buf)
+    else:
+        compress_size = file_size
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = compress_size
+    if not zip64 and max(file_size, compress_size) > zipfile.ZIP64_LIMIT:
+        raise RuntimeError('%s is too large for a zip file' % arcname)
+    # Seek backwards and write file header (which will now include
+    # correct CRC and file sizes)
+    position = zf.fp.tell()
+    zf.fp.seek(zinfo.header_offset, 0)
+    zf.fp.write(zinfo.FileHeader(zip64))
+    zf.fp.seek(position, 0)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+
+
+def write_raw_member(zf, zinfo, fp):
+    """Write a member whose data has already been compressed into zf.
+
+    zinfo must hold the member's CRC and sizes, and zinfo.compress_size
+    bytes of compressed data are copied from fp.
+    """
+    zinfo.header_offset = zf.fp.tell()
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    zf.fp.write(zinfo.FileHeader())
+    remaining = zinfo.compress_size
+    while remaining:
+        buf = fp.read(min(remaining, CHUNK_SIZE))
+        remaining -= len(buf)
+        zf.fp.write(buf)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+
+
+def copy_zip_member(src, zinfo, dest):
+    """Copy member zinfo of zip src into zip dest, without decompressing
+    and recompressing its data.
+    """
+    src.fp.seek(zinfo.header_offset, 0)
+    fheader = struct.unpack(zipfile.structFileHeader,
+                            src.fp.read(zipfile.sizeFileHeader))
+    src.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] +
+                fheader[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+    new = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+    new.external_attr = zinfo.external_attr
+    new.compress_type = zinfo.compress_type
+    new.flag_bits = zinfo.flag_bits & ~0x08
+    new.CRC = zinfo.CRC
+    new.file_size = zinfo.file_size
+    new.compress_size = zinfo.compress_size
+    write_raw_member(dest, new, src.fp)
+
+
+def spool_member(chunks, compress_type=zipfile.ZIP_DEFLATED,
+                 level=zlib.Z_DEFAULT_COMPRESSION):
+    """Compress the strings yielded by chunks into a temporary file, so
+    that the member can be written with its CRC and sizes known up front.
+
+    Returns (file, CRC, size, compressed size).
+    """
+    out = tempfile.SpooledTemporaryFile(1 << 20)
+    if compress_type == zipfile.ZIP_DEFLATED:
+        cmpr = zlib.compressobj(level, zlib.DEFLATED, -15)
+    else:
+        cmpr = None
+    crc = file_size = compress_size = 0
+    for buf in chunks:
+        file_size += len(buf)
+        crc = zlib.crc32(buf, crc) & 0xffffffff
+        if cmpr:
+            buf = cmpr.compress(buf)
+        compress_size += len(buf)
+        out.write(buf)
+    if cmpr:
+        buf = cmpr.flush()
+        compress_size += len(buf)
+        out.write(buf)
+    out.seek(0)
+    return out, crc, file_size, compress_size
+
+
+def deflate_file(path, level):
+    """Deflate the file at path into a temporary file.
+
+    Returns (file, CRC, size, compressed size).  This runs in the
+    ArchiveWriter's thread pool.
+    """
+    return spool_member(iter_file(open(path, 'rb')), level=level)
+
+
+class OutputStream:
+    """Write-only file wrapping a stream that cannot seek, such as stdout.
+
+    It counts the bytes written, so that ZipFile can tell() where each
+    member starts.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.pos = 0
+
+    def write(self, data):
+        self.fp.write(data)
+        self.pos += len(data)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        self.fp.flush()
+
+
+class ArchiveWriter:
+    """The zip file that an export is written to.
+
+    Members are deflated at the given level, except those whose content
+    type is listed in compressed_types, which are stored as they are.
+    Members of at least threshold bytes which are available as a file on
+    disk are compressed by a pool of threads (zlib releases the GIL while
+    it works), and are appended to the zip file when they are done.
+
+    With stream, filename is a file that cannot seek, such as an
+    OutputStream.  Every member is then compressed before it is written,
+    so that its header never needs to be rewritten.
+    """
+
+    def __init__(self, filename, level=6, threads=0, threshold=1 << 20,
+                 stream=False):
+        self.zf = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED,
+                                  allowZip64=True)
+        self.stream = stream
+        self.level = level
+        self.threshold = threshold
+        self.pool = ThreadPool(threads) if threads else None
+        self.max_pending = 2 * threads
+        # [(arcname, AsyncResult)] of members being compressed, in the
+        # order they were written
+        self.pending = []
+        self.names = set()
+
+    def __contains__(self, arcname):
+        return arcname in self.names
+
+    def get_compress_type(self, content_type):
+        if content_type:
+            for compressed_type in compressed_types:
+                if content_type.startswith(compressed_type):
+                    return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def write(self, arcname, chunks, size=None, content_type=None,
+              path=None):
+        """Write the strings yielded by chunks as member arcname.
+
+        If path names a file on disk which holds the same data, a large
+        member is compressed from that file in the thread pool instead, and
+        chunks is not used.
+        """
+        self.names.add(arcname)
+        compress_type = self.get_compress_type(content_type)
+        if self.pool and path and size >= self.threshold \
+                and compress_type == zipfile.ZIP_DEFLATED:
+            while len(self.pending) >= self.max_pending:
+                self.flush(wait=True)
+            result = self.pool.apply_async(deflate_file, (path, self.level))
+            self.pending.append((arcname, result))
+        elif self.stream:
+            self.write_spooled(arcname, compress_type, spool_member(
+                chunks, compress_type, self.level))
+        else:
+            write_zip_member(self.zf, arcname, chunks, size=size,
+                             compress_type=compress_type, level=self.level)
+        self.flush()
+
+    def flush(self, wait=False):
+        """Append the members that the thread pool has finished, in the
+        order they were written.  With wait, block until the first pending
+        member is done.
+        """
+        while self.pending and (wait or self.pending[0][1].ready()):
+            arcname, result = self.pending.pop(0)
+            self.write_spooled(arcname, zipfile.ZIP_DEFLATED, result.get())
+            wait = False
+
+    def drain(self):
+        """Append all members that are still being compressed.
+        """
+        while self.pending:
+            self.flush(wait=True)
+
+    def write_spooled(self, arcname, compress_type, spooled):
+        """Write a member from the (file, CRC, size, compressed size)
+        returned by spool_member.
+        """
+        fp, crc, file_size, compress_size = spooled
+        zinfo = zipfile.ZipInfo(arcname, time.localtime()[:6])
+        zinfo.external_attr = 0600 << 16L
+        zinfo.compress_type = compress_type
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        write_raw_member(self.zf, zinfo, fp)
+        fp.close()
+
+    def copy(self, src, zinfo):
+        """Copy member zinfo of the open ZipFile src into this archive.
+        """
+        self.names.add(zinfo.filename)
+        copy_zip_member(src, zinfo, self.zf)
+
+    def close(self):
+        self.drain()
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+        self.zf.close()
+
+
+class Metrics:
+    """Measurements of each phase of a run, written as JSON with --metrics.
+
+    A phase records its wall time, the objects it handled, the catalog
+    queries it made, the bytes of file data it moved, and the peak RSS of
+    the process when it ended.  Phases with the same name are added up.
+    With profile, every phase runs under cProfile, and the profile of the
+    slowest one is written to that file.
+    """
+
+    def __init__(self, filename='', profile=''):
+        self.filename = filename
+        self.profile = profile
+        self.started = time.time()
+        self.phases = OrderedDict()
+        self.current = None
+        self.slowest = None
+
+    def add(self, counter, value=1):
+        """Add value to a counter of the current phase.
+        """
+        if self.current is not None:
+            self.current[counter] = self.current.get(counter, 0) + value
+
+    @contextmanager
+    def phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = {'seconds': 0.0, 'objects': 0,
+                                 'catalog_queries': 0, 'blob_bytes': 0}
+        outer, self.current = self.current, self.phases[name]
+        profiler = None
+        if self.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            if profiler:
+                profiler.disable()
+                if self.slowest is None or elapsed > self.slowest[1]:
+                    self.slowest = (name, elapsed)
+                    profiler.dump_stats(self.profile)
+            self.current['seconds'] += elapsed
+            self.current['peak_rss_mb'] = peak_rss()
+            self.current = outer
+
+    def write(self):
+        """Write the report to the --metrics file, if one was given.
+        """
+        if not self.filename:
+            return
+        phases = []
+        for name, phase in self.phases.items():
+            phase = dict(phase, name=name)
+            phase['objects_per_second'] = phase['objects'] / \
+                phase['seconds'] if phase['seconds'] else 0
+            phases.append(phase)
+        report = {
+            'started': self.started,
+            'seconds': time.time() - self.started,
+            'peak_rss_mb': peak_rss(),
+            'phases': phases,
+        }
+        if self.slowest:
+            report['profile'] = {'phase': self.slowest[0],
+                                 'filename': self.profile}
+        with open(self.filename, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+
+def peak_rss():
+    """Return the peak resident set size of this process, in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def in_paths(path, prefixes):
+    """Return whether path is one of prefixes, or inside one of them.
+    """
+    for prefix in prefixes:
+        if path == prefix or path.startswith(prefix + '/'):
+            return True
+    return False
+
+
+def get_rids(catalog, results):
+    """Return the record ids of the objects found by a catalog query, in
+    the order of results.
+
+    The LazyMap of a ZCatalog query holds the record ids that it makes its
+    brains from, so no brain needs to be made.  The record ids of other
+    results, such as those of a sort which merges several result sets, are
+    taken from their brains, which are released with the results.
+    """
+    func = getattr(results, '_func', None)
+    if func is not None and func == catalog._catalog.__getitem__:
+        return list(results._seq)
+    return [brain.getRID() for brain in results]
+
+
+def open_app(args, at=None):
+    """Open a new, read-only connection to the database, and return the
+    Zope application root.
+
+    The storage named with --filestorage is used if given, otherwise the
+    main database of the running instance's configuration is opened again.
+    If at is given, the connection sees the database as it was after the
+    transaction with that id.
+    """
+    from Testing.makerequest import makerequest
+    from ZODB.DB import DB
+    if args.filestorage:
+        from ZODB.FileStorage import FileStorage
+        storage = FileStorage(args.filestorage, read_only=True,
+                              blob_dir=args.blobstorage or None)
+    else:
+        from App.config import getConfiguration
+        factory = getConfiguration().dbtab.getDatabaseFactory(name='main')
+        storage_config = factory.config.storage
+        storage_config.config.read_only = True
+        storage = storage_config.open()
+    db = DB(storage)
+    return makerequest(db.open(at=at).root()['Application'])
+
+
+def run_worker(args, scope, at, tasks, results, partdir):
+    """Worker process for parallel export.
+
+    Exports the (nr, portal_type, start, stop) ranges read from tasks into
+    partial archives in partdir, and reports (nr, filename, error) for
+    each of them on results.  A task of None stops the worker.  scope is
+    the parent's, see Main.get_scope, and at the id of the transaction
+    that all the workers read the database at.
+    """
+    main = Main(args, open_app(args, at))
+    main.scope = scope
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        nr, portal_type, start, stop = task
+        filename = os.path.join(partdir, 'part-%05d.zip' % nr)
+        try:
+            main.export_part(filename, portal_type, start, stop)
+        except Exception:
+            results.put((nr, None, traceback.format_exc()))
+            break
+        results.put((nr, filename, None))
+
+
+class SheetWriter:
+    """Buffered row writer for a single write-only worksheet.
+
+    Rows are appended to the worksheet in batches, and the number of rows
+    written is tracked here so that the sheet never needs to be re-read.
+    """
+
+    def __init__(self, ws, headers, buffer_size=1000):
+        self.ws = ws
+        self.headers = headers
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.nr_rows = 0
+        if headers:
+            self.append(headers)
+
+    def append(self, row):
+        self.buffer.append(row)
+        self.nr_rows += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        for row in self.buffer:
+            self.ws.append(row)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+
+class JSONLSheetWriter(SheetWriter):
+    """Buffered row writer for a sheet stored as JSON lines.
+
+    Every row is written as a JSON array on a line of its own, to a
+    temporary file which is added to the archive when it is closed.
+    """
+
+    def __init__(self, headers, buffer_size=1000):
+        fd, self.path = tempfile.mkstemp(suffix='.jsonl')
+        self.fp = os.fdopen(fd, 'wb')
+        SheetWriter.__init__(self, None, headers, buffer_size)
+
+    def flush(self):
+        self.fp.write(''.join(
+            json.dumps(row, default=unicode) + '\n' for row in self.buffer))
+        self.buffer = []
+
+    @property
+    def closed(self):
+        return self.fp.closed
+
+    def close(self):
+        if not self.fp.closed:
+            self.flush()
+            self.fp.close()
+
+
+class ShardedSheet:
+    """A sheet whose rows are split over shards of at most max_rows rows.
+
+    The first shard is named sheetname, and the following ones
+    sheetname_0001, sheetname_0002, and so on, with names longer than 26
+    characters cut and followed by a short hash.  Every shard starts with its
+    own copy of the headers, so that each can be read on its own.
+    create(shardname, headers) must return the writer for a new shard.
+    """
+
+    def __init__(self, sheetname, headers, create, max_rows=0):
+        self.sheetname = sheetname
+        self.headers = headers
+        self.create = create
+        self.max_rows = max_rows
+        self.shards = []
+        self.nr_rows = 0
+        self.is_cut = False
+        self.add_shard()
+
+    def add_shard(self):
+        nr = len(self.shards)
+        if nr and len(self.sheetname) > 26:
+            # Worksheet titles may not be longer than 31 characters.  A
+            # hash of the full name keeps apart sheets that are cut to the
+            # same prefix.
+            shardname = '%s_%s_%04d' % (
+                self.sheetname[:21],
+                hashlib.sha1(self.sheetname).hexdigest()[:4], nr)
+        elif nr:
+            shardname = '%s_%04d' % (self.sheetname, nr)
+        else:
+            shardname = self.sheetname
+        self.shards.append((shardname, self.create(shardname, self.headers)))
+
+    def append(self, row):
+        writer = self.shards[-1][1]
+        if self.is_cut or \
+                self.max_rows and writer.nr_rows >= self.max_rows:
+            writer.close()
+            self.add_shard()
+            writer = self.shards[-1][1]
+            self.is_cut = False
+        writer.append(row)
+        self.nr_rows += 1
+
+    def cut(self):
+        """Close the current shard; the next row will start a new one.
+        """
+        self.shards[-1][1].close()
+        self.is_cut = True
+
+    def flush(self):
+        for shardname, writer in self.shards:
+            writer.flush()
+
+    def close(self):
+        for shardname, writer in self.shards:
+            writer.close()
+
+
+def iter_part_sheets(zf):
+    """Yield (sheetname, rows) for every sheet or shard of the partial
+    archive zf, in the order they were created.  rows iterates over lists
+    of values, starting with the headers.
+    """
+    manifest = json.loads(zf.read('manifest.json'))
+    # Shards are yielded under the name of the sheet they are part of
+    sheet_of = {}
+    for sheetname, shardnames in manifest.get('shards', []):
+        for shardname in shardnames:
+            sheet_of[shardname] = sheetname
+    if manifest['format'] == 'jsonl':
+        for shardname, info in manifest['sheets']:
+            src = zf.open(info['member'])
+            yield sheet_of.get(shardname, shardname), \
+                (json.loads(line) for line in src)
+            src.close()
+        return
+    wbfile = tempfile.TemporaryFile()
+    src = zf.open('setupdata.xlsx')
+    shutil.copyfileobj(src, wbfile, CHUNK_SIZE)
+    src.close()
+    wbfile.seek(0)
+    wb = openpyxl.load_workbook(wbfile, read_only=True)
+    for ws in wb.worksheets:
+        yield sheet_of.get(ws.title, ws.title), \
+            ([cell.value for cell in row] for row in ws.rows)
+    wb.close()
+    wbfile.close()
+
+
 class Main:
-    def __init__(self, args):
+    def __init__(self, args, app=app):
         self.args = args
         # pose as user
         self.user = app.acl_users.getUserById(args.username)
@@ -113,30 +783,546 @@ class Main:
         self.portal = app.unrestrictedTraverse(args.sitepath)
 
         self.proxy_cache = {}
+        self.archetype_tool = getToolByName(self.portal, 'archetype_tool')
+        self.catalogs = {}
+        self.extensions = None
+        self.plans = {}
+        # Incremental export: only objects modified since the export named
+        # with --since are written.
+        self.timestamp = time.time()
+        self.parent = self.load_parent() if args.since else None
+        self.metrics = Metrics(args.metrics, args.profile)
+        # Types, paths and UIDs selected by the filter options; see
+        # get_scope.
+        self.scope = None
 
     def __call__(self):
         """Export entire bika site
         """
-        self.tempdir = tempfile.mkdtemp()
-        # Export into tempdir
-        self.wb = openpyxl.Workbook()
-        self.export_laboratory()
-        self.export_bika_setup()
+        with self.metrics.phase('scope'):
+            self.scope = self.get_scope()
+        self.open_archive(self.args.outputfile)
+        with self.metrics.phase('Laboratory'):
+            self.export_laboratory()
+        with self.metrics.phase('BikaSetup'):
+            self.export_bika_setup()
+        with self.metrics.phase('uids'):
+            self.write_uids()
+        self.finish_type('BikaSetup')
+        if self.args.jobs > 1:
+            with self.metrics.phase('parallel'):
+                self.export_parallel()
+        else:
+            for portal_type in export_types:
+                with self.metrics.phase(portal_type):
+                    if portal_type in self.scope['types']:
+                        self.export_portal_type(portal_type)
+                    self.finish_type(portal_type)
+        with self.metrics.phase('archive'):
+            self.close_archive()
+        self.metrics.write()
+
+    def open_archive(self, filename):
+        # Create zip file; file field values are streamed into it as they
+        # are exported.
+        stream = filename == '-'
+        if stream:
+            # Progress messages are printed to stderr instead
+            filename = OutputStream(sys.__stdout__)
+        self.archive = ArchiveWriter(
+            filename, level=self.args.compress_level,
+            threads=self.args.compress_threads,
+            threshold=self.args.compress_threshold, stream=stream)
+        if self.args.format == 'xlsx':
+            self.wb = openpyxl.Workbook(write_only=True)
+        self.sheets = OrderedDict()
+        self.written = set()
+        self.tempfiles = []
+        self.manifest = OrderedDict([
+            ('format', self.args.format),
+            ('timestamp', self.timestamp),
+            ('parent', os.path.basename(self.args.since) if self.parent
+             else None),
+            ('filters', self.get_filters()),
+            ('sheets', []),
+        ])
+        if stream:
+            # The manifest is written last; an import reading the stream
+            # needs to know what it is reading before that.
+            self.archive.write('stream.json', [json.dumps(self.manifest)])
+
+    def close_archive(self):
+        """Write the sheets and manifest.json, and close the archive.
+        """
+        if self.args.format == 'jsonl':
+            self.write_jsonl_sheets(cut=True)
+        else:
+            self.write_workbook()
+        self.manifest['shards'] = self.get_shard_lists()
+        self.archive.write('manifest.json', [json.dumps(self.manifest)])
+        try:
+            self.archive.close()
+        finally:
+            for filename in self.tempfiles:
+                os.remove(filename)
+
+    def get_shard_lists(self):
+        """Return [(sheetname, [shardname, ...]), ...] for the sheets which
+        have been split into shards.
+        """
+        return [(sheetname, [shardname for shardname, writer in sheet.shards])
+                for sheetname, sheet in self.sheets.items()
+                if len(sheet.shards) > 1]
+
+    def finish_type(self, portal_type):
+        """Write out the rows of a type that has been exported completely,
+        when writing jsonl to a stream.
+
+        All sheets are cut, their shards are written, and then a
+        types/<portal_type>.json member which lists them.  An import that
+        is reading the stream can start on the type when it sees this.
+        """
+        if not self.archive.stream or self.args.format != 'jsonl':
+            return
+        sheets = self.write_jsonl_sheets(cut=True)
+        # The marker must follow the shards it lists
+        self.archive.drain()
+        marker = {'sheets': sheets, 'shards': self.get_shard_lists()}
+        self.archive.write('types/%s.json' % portal_type,
+                           [json.dumps(marker)])
+
+    def write_workbook(self):
+        """Write all sheets to setupdata.xlsx, and return the name of the
+        temporary file it was saved to.
+        """
+        for sheet in self.sheets.values():
+            sheet.flush()
+        # The workbook can only be saved to a seekable file
+        fd, wbfile = tempfile.mkstemp(suffix='.xlsx')
+        os.close(fd)
+        self.tempfiles.append(wbfile)
+        self.wb.save(wbfile)
+        self.archive.write(
+            'setupdata.xlsx', iter_file(open(wbfile, 'rb')),
+            size=os.path.getsize(wbfile), path=wbfile)
+
+    def write_jsonl_sheets(self, cut=False):
+        """Write every closed shard of a sheet that has not been written yet
+        to its own sheets/<name>.jsonl member, and list them in the
+        manifest.  With cut, the shards being written to are closed first,
+        and later rows go to new shards.  Return the manifest entries of the
+        shards that were written.
+        """
+        sheets = []
+        for sheet in self.sheets.values():
+            if cut:
+                sheet.cut()
+            for shardname, writer in sheet.shards:
+                if shardname in self.written or not writer.closed:
+                    continue
+                self.written.add(shardname)
+                self.tempfiles.append(writer.path)
+                member = 'sheets/%s.jsonl' % shardname
+                self.archive.write(
+                    member, iter_file(open(writer.path, 'rb')),
+                    size=os.path.getsize(writer.path),
+                    content_type='application/json', path=writer.path)
+                sheets.append((shardname, {'member': member,
+                                           'rows': writer.nr_rows}))
+        self.manifest['sheets'].extend(sheets)
+        return sheets
+
+    def export_part(self, filename, portal_type, start, stop):
+        """Export objects start to stop of portal_type into a partial
+        archive, to be merged by export_parallel.
+        """
+        self.open_archive(filename)
+        self.export_portal_type(portal_type, start, stop)
+        self.close_archive()
+
+    def load_parent(self):
+        """Return the manifest and UIDs of the archive named with --since.
+        """
+        zf = zipfile.ZipFile(self.args.since, 'r', allowZip64=True)
+        if 'manifest.json' not in zf.NameToInfo:
+            raise RuntimeError(
+                '%s has no manifest, it cannot be used with --since' %
+                self.args.since)
+        parent = json.load(zf.open('manifest.json'))
+        if parent.get('filters', {}) != self.get_filters():
+            raise RuntimeError(
+                '%s was exported with other filters, it cannot be used with'
+                ' --since' % self.args.since)
+        parent['uids'] = json.load(zf.open('uids.json'))
+        zf.close()
+        return parent
+
+    def get_filters(self):
+        """Return the filter options, as they are recorded in the manifest.
+        """
+        filters = OrderedDict()
+        for name in ('include_types', 'exclude_types', 'clients', 'paths'):
+            if getattr(self.args, name):
+                filters[name] = sorted(getattr(self.args, name))
+        if self.args.closure:
+            filters['closure'] = True
+        return filters
+
+    def is_included(self, portal_type):
+        """Return whether --include-type and --exclude-type select
+        portal_type.
+        """
+        if self.args.include_types \
+                and portal_type not in self.args.include_types:
+            return False
+        return portal_type not in self.args.exclude_types
+
+    def get_scope(self):
+        """Return the objects selected by the filter options, as
+        {'types': [portal_type, ...], 'paths': [path, ...],
+         'uids': {portal_type: [UID, ...]}}.
+
+        types are the portal_types to export.  Their objects are those
+        inside paths, physical paths of --path prefixes and of the folders
+        of --client clients, if any are given, and otherwise all of them.
+        Types whose catalog has no path index, and all types with
+        --closure, have their objects listed in uids instead.
+        """
+        portal_path = '/'.join(self.portal.getPhysicalPath())
+        paths = ['%s/%s' % (portal_path, path.strip('/'))
+                 for path in self.args.paths]
+        for uid in self.args.clients:
+            catalog = self.get_catalog('Client')
+            self.metrics.add('catalog_queries')
+            brains = catalog(portal_type='Client', UID=uid)
+            if not brains:
+                raise RuntimeError('Client %s not found' % uid)
+            paths.append(brains[0].getPath())
+        types = [portal_type for portal_type in export_types
+                 if self.is_included(portal_type)]
+        uids = {}
+        for portal_type in types if paths else []:
+            catalog = self.get_catalog(portal_type)
+            if 'path' not in catalog.indexes():
+                print "%s has no path index, filtering %s objects" % (
+                    catalog.id, portal_type)
+                self.metrics.add('catalog_queries')
+                uids[portal_type] = [
+                    brain.UID for brain in catalog(portal_type=portal_type)
+                    if in_paths(brain.getPath(), paths)]
+        self.scope = {'types': types, 'paths': paths, 'uids': uids}
+        if self.args.closure:
+            uids = self.get_closure()
+            types = [portal_type for portal_type in export_types
+                     if portal_type in uids]
+        types = [portal_type for portal_type in types
+                 if uids.get(portal_type, True)]
+        return {'types': types, 'paths': paths, 'uids': uids}
+
+    def get_closure(self):
+        """Return {portal_type: [UID, ...]} of the objects in scope, and of
+        the objects they reference or are contained in, recursively, so
+        that the archive can be imported into a site which has none of
+        them.  Types excluded with --exclude-type are not followed.
+        """
+        rc = getToolByName(self.portal, 'reference_catalog')
+        found = {}
+        queue = []
+        for portal_type in self.scope['types']:
+            catalog = self.get_catalog(portal_type)
+            self.metrics.add('catalog_queries')
+            for brain in catalog(**self.get_scope_query(portal_type)):
+                found[brain.UID] = portal_type
+                queue.append(brain.UID)
+        nr_scoped = len(found)
+        while queue:
+            instance = rc.lookupObject(queue.pop())
+            targets = [aq_parent(aq_inner(instance))]
+            for field in instance.schema.fields():
+                if not Field.IReferenceField.providedBy(field):
+                    continue
+                value = field.get(instance)
+                if field.multiValued:
+                    targets.extend(value or [])
+                elif value:
+                    targets.append(value)
+            for target in targets:
+                portal_type = getattr(target, 'portal_type', None)
+                if portal_type not in export_types \
+                        or portal_type in self.args.exclude_types:
+                    continue
+                uid = target.UID()
+                if uid not in found:
+                    found[uid] = portal_type
+                    queue.append(uid)
+            aq_base(instance)._p_deactivate()
+        print "%d objects in scope, and %d objects they depend on" % (
+            nr_scoped, len(found) - nr_scoped)
+        uids = {}
+        for uid, portal_type in found.items():
+            uids.setdefault(portal_type, []).append(uid)
+        return uids
+
+    def get_scope_query(self, portal_type):
+        """Return the catalog query for the objects of portal_type in scope.
+        """
+        query = {'portal_type': portal_type}
+        if portal_type in self.scope['uids']:
+            query['UID'] = self.scope['uids'][portal_type]
+        elif self.scope['paths']:
+            query['path'] = {'query': self.scope['paths']}
+        return query
+
+    def get_query(self, portal_type):
+        """Return the catalog query for the objects of portal_type that must
+        be exported.
+        """
+        query = self.get_scope_query(portal_type)
+        if self.parent:
+            catalog = self.get_catalog(portal_type)
+            if 'modified' in catalog.indexes():
+                query['modified'] = {
+                    'query': DateTime(self.parent['timestamp']),
+                    'range': 'min'}
+            else:
+                print "%s has no modified index, exporting all %s objects" % (
+                    catalog.id, portal_type)
+        return query
+
+    def write_uids(self):
+        """Write uids.json.
+
+        uids.json maps the UID of every object of each type that exists now
+        to its path, so that a later export with --since can tell which
+        objects were deleted.  Deletions since the parent archive are
+        written to the Tombstones sheet.  Only objects in scope are
+        listed, so objects which have left it are deleted too.
+        """
+        portal_path = '/'.join(self.portal.getPhysicalPath())
+
+        def generate():
+            yield '{'
+            for nr, portal_type in enumerate(export_types):
+                yield '%s%s: {' % (', ' if nr else '', json.dumps(portal_type))
+                uids = set()
+                brains = []
+                if portal_type in self.scope['types']:
+                    catalog = self.get_catalog(portal_type)
+                    self.metrics.add('catalog_queries')
+                    brains = catalog(**self.get_scope_query(portal_type))
+                for i, brain in enumerate(brains):
+                    uids.add(brain.UID)
+                    yield '%s%s: %s' % (
+                        ', ' if i else '', json.dumps(brain.UID),
+                        json.dumps(brain.getPath()[len(portal_path):]))
+                yield '}'
+                if self.parent:
+                    self.write_tombstones(portal_type, uids)
+            yield '}'
+
+        # uids.json is streamed, rather than built in memory
+        self.archive.write('uids.json', iter_chunks(generate()))
+
+    def write_tombstones(self, portal_type, uids):
+        """Write the objects of portal_type that were in the parent archive
+        but are not in uids to the Tombstones sheet.
+        """
+        parent_uids = self.parent['uids'].get(portal_type, {})
+        for uid, path in parent_uids.items():
+            if uid not in uids:
+                sheet = self.get_sheet(
+                    'Tombstones', ['portal_type', 'uid', 'path'])
+                sheet.append([portal_type, uid, path])
+
+    def plan_tasks(self):
+        """Return the (nr, portal_type, start, stop) ranges that the worker
+        processes will export.  Types with more than --chunk-rows objects
+        are split into several ranges.  The last range of a type is left
+        open, so that it takes the objects added since they were counted.
+        """
+        tasks = []
+        for portal_type in self.scope['types']:
+            catalog = self.get_catalog(portal_type)
+            nr_objects = len(catalog(**self.get_query(portal_type)))
+            self.metrics.add('catalog_queries')
+            if not nr_objects:
+                print "No objects of type %s found in %s" % (
+                    portal_type, catalog)
+                continue
+            step = self.args.chunk_rows
+            if not step or nr_objects <= step:
+                tasks.append((len(tasks), portal_type, 0, None))
+                continue
+            for start in range(0, nr_objects, step):
+                stop = start + step if start + step < nr_objects else None
+                tasks.append((len(tasks), portal_type, start, stop))
+        return tasks
+
+    def export_parallel(self):
+        """Export all types in --jobs worker processes, each with its own
+        database connection, and merge their partial archives into this one.
+
+        Parts are merged in task order as soon as they are available, so
+        merging overlaps with the remaining exports.
+
+        The workers open their connections at different times, so they all
+        read the database as of the last transaction before the ranges
+        are planned.  Objects added or removed meanwhile would otherwise
+        shift the offsets of the ranges.
+        """
+        jar = self.portal._p_jar
+        jar.sync()
+        at = jar.db().lastTransaction()
+        tasks = self.plan_tasks()
         for portal_type in export_types:
-            self.export_portal_type(portal_type)
-        self.wb.save(os.path.join(self.tempdir, 'setupdata.xlsx'))
-        # Create zip file
-        zf = zipfile.ZipFile(self.args.outputfile, 'w', zipfile.ZIP_DEFLATED)
-        for fname in os.listdir(self.tempdir):
-            zf.write(os.path.join(self.tempdir, fname), fname)
+            if portal_type not in [task[1] for task in tasks]:
+                self.finish_type(portal_type)
+        partdir = tempfile.mkdtemp()
+        task_queue = multiprocessing.Queue()
+        result_queue = multiprocessing.Queue()
+        for task in tasks:
+            task_queue.put(task)
+        workers = []
+        for i in range(self.args.jobs):
+            task_queue.put(None)
+            worker = multiprocessing.Process(
+                target=run_worker,
+                args=(self.args, self.scope, at, task_queue, result_queue,
+                      partdir))
+            worker.start()
+            workers.append(worker)
+        try:
+            parts = {}
+            next_nr = 0
+            while next_nr < len(tasks):
+                try:
+                    nr, filename, error = result_queue.get(timeout=1)
+                except Queue.Empty:
+                    self.check_workers(workers, result_queue)
+                    continue
+                if error:
+                    raise RuntimeError('Export of %s failed:\n%s' % (
+                        tasks[nr][1], error))
+                parts[nr] = filename
+                while next_nr in parts:
+                    filename = parts.pop(next_nr)
+                    self.merge_part(filename)
+                    os.remove(filename)
+                    portal_type = tasks[next_nr][1]
+                    next_nr += 1
+                    if next_nr == len(tasks) or \
+                            tasks[next_nr][1] != portal_type:
+                        self.finish_type(portal_type)
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+            shutil.rmtree(partdir)
+
+    def check_workers(self, workers, results):
+        """Raise RuntimeError if a worker process died, or if all of them
+        have stopped and no results are left, while results are still
+        awaited.  A worker that is killed, or fails before it reads its
+        first task, reports nothing.
+        """
+        for worker in workers:
+            if worker.exitcode:
+                raise RuntimeError(
+                    'Export worker %s died with exit code %s' % (
+                        worker.pid, worker.exitcode))
+        if not any(worker.is_alive() for worker in workers) \
+                and results.empty():
+            raise RuntimeError('Export workers stopped before all results '
+                               'were reported')
+
+    def merge_part(self, filename):
+        """Append the sheets and members of a partial archive to ours.
+        """
+        zf = zipfile.ZipFile(filename, 'r', allowZip64=True)
+        for zinfo in zf.infolist():
+            # Blobs shared between parts are only stored once, and sheets
+            # are merged below
+            if zinfo.filename not in ('setupdata.xlsx', 'manifest.json') \
+                    and not zinfo.filename.startswith('sheets/') \
+                    and zinfo.filename not in self.archive:
+                self.archive.copy(zf, zinfo)
+                self.metrics.add('blob_bytes', zinfo.file_size)
+        for sheetname, rows in iter_part_sheets(zf):
+            headers = next(rows)
+            sheet = self.get_sheet(sheetname, headers,
+                                   fit_width=sheetname.endswith('_values'))
+            convert = self.get_part_converter(sheet, headers)
+            nr_rows = 0
+            for row in rows:
+                if convert is not None:
+                    row = convert(row)
+                sheet.append(row)
+                nr_rows += 1
+            if sheetname in export_types:
+                self.metrics.add('objects', nr_rows)
         zf.close()
-        # Remove tempdir
-        shutil.rmtree(self.tempdir)
+
+    def get_part_converter(self, sheet, headers):
+        """Return a function which puts a row of a part, whose columns are
+        headers, into the columns of sheet, or None if they are the same.
+
+        Columns are matched by header.  The columns of a _values sheet for
+        a field without subfields follow the first dictionary that a
+        process writes, so they can differ between parts.  Values in
+        columns that the sheet does not have are added to its OTHER_KEYS
+        column.
+        """
+        if headers == sheet.headers:
+            return None
+        columns = [headers.index(header) if header in headers else None
+                   for header in sheet.headers]
+        unknown = [(col, header) for col, header in enumerate(headers)
+                   if header is not None and header not in sheet.headers]
+        if unknown and OTHER_KEYS not in sheet.headers:
+            raise RuntimeError(
+                'Sheet %s has no columns for %s' % (
+                    sheet.sheetname,
+                    ', '.join(str(header) for col, header in unknown)))
+        other_col = sheet.headers.index(OTHER_KEYS) if unknown else None
+
+        def convert(row):
+            converted = [row[col] if col is not None else ''
+                         for col in columns]
+            other = dict((header, row[col]) for col, header in unknown
+                         if row[col] not in (None, ''))
+            if other:
+                if converted[other_col]:
+                    other.update(json.loads(converted[other_col]))
+                converted[other_col] = json.dumps(
+                    other, sort_keys=True, default=unicode)
+            return converted
+
+        return convert
 
     def get_catalog(self, portal_type):
         # grab the first catalog we are indexed in
-        at = getToolByName(self.portal, 'archetype_tool')
-        return at.getCatalogsByType(portal_type)[0]
+        if portal_type not in self.catalogs:
+            self.catalogs[portal_type] = \
+                self.archetype_tool.getCatalogsByType(portal_type)[0]
+        return self.catalogs[portal_type]
+
+    def get_sheet(self, sheetname, headers=None, fit_width=False):
+        """Return the ShardedSheet for sheetname, creating the sheet and
+        writing its headers if it does not exist yet.
+        """
+        if sheetname not in self.sheets:
+            def create(shardname, headers):
+                if self.args.format == 'jsonl':
+                    return JSONLSheetWriter(headers)
+                ws = self.wb.create_sheet(title=shardname)
+                if fit_width:
+                    ws.page_setup.fitToHeight = 0
+                    ws.page_setup.fitToWidth = 1
+                return SheetWriter(ws, headers)
+            self.sheets[sheetname] = ShardedSheet(
+                sheetname, headers, create, self.args.shard_rows)
+        return self.sheets[sheetname]
 
     def get_fields(self, schema):
         fields = []
@@ -148,161 +1334,222 @@ class Main:
             fields.append(field)
         return fields
 
-    def write_dict_field_values(self, instance, field):
-        value = field.get(instance)
+    def write_dict_field_values(self, instance, field, value):
+        """Write the dictionaries of a field to the sheet of that field,
+        and return the name of the sheet.
+
+        The columns are the field's subfields, or if it has none, the keys
+        of the first dictionary written.  Any other keys of a dictionary
+        are written to the OTHER_KEYS column, as JSON.
+        """
         if type(value) == dict:
             value = [value]
-        keys = value[0].keys()
-        # Create or obtain sheet for this field type's values
-        sheetname = '%s_values' % field.type
+        keys = list(getattr(field, 'subfields', None) or value[0].keys())
+        # Create or obtain sheet for this field's values
+        sheetname = '%s_values' % field.getName()
         sheetname = sheetname[:31]
-        if sheetname in self.wb:
-            ws = self.wb[sheetname]
-        else:
-            ws = self.wb.create_sheet(title=sheetname)
-            ws.page_setup.fitToHeight = 0
-            ws.page_setup.fitToWidth = 1
-            ws.cell(column=1, row=1).value = "id"
-            ws.cell(column=2, row=1).value = "field"
-            for col, key in enumerate(keys):
-                cell = ws.cell(column=col + 3, row=1)
-                cell.value = key
-        nr_rows = len(ws.rows) + 1
-        for row, v in enumerate(value):
+        sheet = self.get_sheet(
+            sheetname, ['id', 'field'] + keys + [OTHER_KEYS], fit_width=True)
+        # Columns are written in the order of the sheet's headers
+        keys = sheet.headers[2:]
+        for v in value:
             if not any(v.values()):
                 break
+            other = dict((key, v[key]) for key in v if key not in keys)
             # source id/field
-            ws.cell(column=1, row=nr_rows + row).value = instance.id
-            ws.cell(column=2, row=nr_rows + row).value = field.getName()
-            for col, key in enumerate(keys):
-                c_value = v.get(key, '')
-                ws.cell(column=col + 3, row=nr_rows + row).value = c_value
+            row = [instance.id, field.getName()]
+            for key in keys:
+                if key == OTHER_KEYS:
+                    row.append(json.dumps(other, sort_keys=True,
+                                          default=unicode) if other else '')
+                else:
+                    row.append(v.get(key, ''))
+            sheet.append(row)
 
         return sheetname
 
-    def write_reference_values(self, instance, field):
-        values = field.get(instance)
+    def write_reference_values(self, instance, field, values):
         # Create or obtain sheet for this relationship
         sheetname = field.relationship[:31]
-        if sheetname in self.wb:
-            ws = self.wb[sheetname]
-        else:
-            ws = self.wb.create_sheet(title=sheetname)
-            ws.cell(column=1, row=1).value = "Source"
-            ws.cell(column=2, row=1).value = "Target"
-        nr_rows = len(ws.rows) + 1
-        for row, value in enumerate(values):
-            ws.cell(column=1, row=nr_rows + row).value = instance.id
-            ws.cell(column=2, row=nr_rows + row).value = value.id
+        sheet = self.get_sheet(sheetname, ['Source', 'Target'])
+        for value in values:
+            sheet.append([instance.id, value.id])
         return sheetname
 
     def get_extension(self, mimetype):
         """Return first extension for mimetype, if any is found.
         If no extension found, return ''
         """
-        mr = getToolByName(self.portal, "mimetypes_registry")
-        extension = ''
-        for ext, mt in mr.extensions.items():
-            if mimetype == mt:
-                extension = ext
-        return extension
-
-    def mutate(self, instance, field):
-        value = field.get(instance)
-        # Booleans are special; we'll str and return them.
-        if value is True or value is False:
-            return str(value)
-        # Zero is special: it's false-ish, but the value is important.
-        if value is 0:
-            return 0
-        # Other falsish values make empty cells.
-        if not value:
+        if self.extensions is None:
+            mr = getToolByName(self.portal, "mimetypes_registry")
+            self.extensions = {}
+            for ext, mt in mr.extensions.items():
+                self.extensions[mt] = ext
+        return self.extensions.get(mimetype, '')
+
+    def write_file(self, instance, field, value):
+        # Files get streamed into the zip once, named after the sha1 of
+        # their contents, and the cell content is
+        # "blobs/<sha1>|content type|filename"
+        if not value.size:
             return ''
+        sha1 = hashlib.sha1()
+        for buf in iter_file_data(value):
+            sha1.update(buf)
+        arcname = 'blobs/' + sha1.hexdigest()
+        if arcname not in self.archive:
+            self.archive.write(arcname, iter_file_data(value),
+                               size=value.size,
+                               content_type=value.content_type,
+                               path=get_blob_path(value))
+            self.metrics.add('blob_bytes', value.size)
+        extension = self.get_extension(value.content_type)
+        filename = value.filename if value.filename \
+            else instance.id + '-' + field.getName() + "." + extension
+        return '%s|%s|%s' % (arcname, value.content_type, filename)
+
+    def serialize_date(self, instance, field, value):
         # Date fields get stringed to rfc8222
+        return value.rfc822()
+
+    def serialize_verbatim(self, instance, field, value):
+        return value
+
+    def serialize_reference(self, instance, field, value):
+        return value.id
+
+    def serialize_lines(self, instance, field, value):
+        return "\n".join(value)
+
+    def serialize_value(self, instance, field, value):
+        # depend on value of field, to decide mutation.
+        # Dictionaries or lists of dictionaries
+        if type(value) == dict \
+                or (type(value) in (list, tuple)
+                    and type(value[0]) == dict):
+            return self.write_dict_field_values(instance, field, value)
+        else:
+            return value
+
+    def compile_serializer(self, field):
+        """Return a function which returns the cell value of field for an
+        instance.  The interface checks are made once, here, rather than
+        once for every cell.
+        """
         if Field.IDateTimeField.providedBy(field):
-            return value.rfc822() if value else None
+            convert = self.serialize_date
         # TextField implements IFileField, so we must handle it
         # before IFileField. It's just returned verbatim.
         elif Field.ITextField.providedBy(field):
-            return value
-        # Files get saved into tempdir, and the cell content is the filename
+            convert = self.serialize_verbatim
         elif Field.IFileField.providedBy(field):
-            if not value.size:
-                return ''
-            extension = self.get_extension(value.content_type)
-            filename = value.filename if value.filename \
-                else instance.id + '-' + field.getName() + "." + extension
-            of = open(os.path.join(self.tempdir, filename), 'wb')
-            of.write(value.data)
-            of.close()
-            return filename
+            convert = self.write_file
         elif Field.IReferenceField.providedBy(field):
             if field.multiValued:
-                return self.write_reference_values(instance, field)
+                convert = self.write_reference_values
             else:
-                return value.id
+                convert = self.serialize_reference
         elif Field.ILinesField.providedBy(field):
-            return "\n".join(value)
-        # depend on value of field, to decide mutation.
+            convert = self.serialize_lines
+        # RecordField and RecordsField
+        elif field.type in ('record', 'records'):
+            convert = self.write_dict_field_values
         else:
-            value = field.get(instance)
-            # Dictionaries or lists of dictionaries
-            if type(value) == dict \
-                    or (type(value) in (list, tuple)
-                        and type(value[0]) == dict):
-                return self.write_dict_field_values(instance, field)
-            else:
-                return value
+            convert = self.serialize_value
+        get = field.get
+
+        def serialize(instance):
+            value = get(instance)
+            # Booleans are special; we'll str and return them.
+            if value is True or value is False:
+                return str(value)
+            # Zero is special: it's false-ish, but the value is important.
+            if value is 0:
+                return 0
+            # Other falsish values make empty cells.
+            if not value:
+                return ''
+            return convert(instance, field, value)
+
+        return serialize
+
+    def get_plan(self, instance):
+        """Return [(fieldname, serializer), ...] for the exported fields of
+        instance's schema.  Plans are compiled once for each portal_type.
+        """
+        portal_type = instance.portal_type
+        if portal_type not in self.plans:
+            self.plans[portal_type] = [
+                (field.getName(), self.compile_serializer(field))
+                for field in self.get_fields(instance.schema)]
+        return self.plans[portal_type]
+
+    def includes_settings(self, sheetname, instance):
+        """Return whether the Laboratory or BikaSetup sheet is in scope.
+        """
+        if not self.is_included(sheetname):
+            return False
+        return not self.scope['paths'] or in_paths(
+            '/'.join(instance.getPhysicalPath()), self.scope['paths'])
 
     def export_laboratory(self):
         instance = self.portal.bika_setup.laboratory
-        ws = self.wb.create_sheet(title='Laboratory')
-        ws.page_setup.fitToHeight = 0
-        ws.page_setup.fitToWidth = 1
-        fields = self.get_fields(instance.schema)
-        for row, field in enumerate(fields):
-            ws.cell(column=1, row=row + 1).value = field.getName()
-            value = self.mutate(instance, field)
-            ws.cell(column=2, row=row + 1).value = value
+        if not self.includes_settings('Laboratory', instance):
+            return
+        sheet = self.get_sheet('Laboratory', fit_width=True)
+        for fieldname, serialize in self.get_plan(instance):
+            sheet.append([fieldname, serialize(instance)])
+        self.metrics.add('objects')
 
     def export_bika_setup(self):
         instance = self.portal.bika_setup
-        ws = self.wb.create_sheet(title='BikaSetup')
-        fields = self.get_fields(instance.schema)
-        for row, field in enumerate(fields):
-            ws.cell(column=1, row=row + 1).value = field.getName()
-            value = self.mutate(instance, field)
-            ws.cell(column=2, row=row + 1).value = value
-
-    def export_portal_type(self, portal_type):
+        if not self.includes_settings('BikaSetup', instance):
+            return
+        sheet = self.get_sheet('BikaSetup')
+        for fieldname, serialize in self.get_plan(instance):
+            sheet.append([fieldname, serialize(instance)])
+        self.metrics.add('objects')
+
+    def export_portal_type(self, portal_type, start=0, stop=None):
         catalog = self.get_catalog(portal_type)
-        brains = catalog(portal_type=portal_type)
-        if not brains:
+        query = self.get_query(portal_type)
+        # A catalog result keeps every brain that is taken from it, even
+        # through a slice, so only the record ids of the objects are kept,
+        # and each object is looked up from its id.  Ranges of a type
+        # exported in separate processes are taken from the same, stable
+        # ordering.  Ids are only unique within a folder, so they are
+        # sorted on UID.
+        self.metrics.add('catalog_queries')
+        rids = get_rids(catalog, catalog(sort_on='UID', **query))
+        rids = rids[start:stop]
+        if not rids:
             print "No objects of type %s found in %s" % (portal_type, catalog)
             return
-        ws = self.wb.create_sheet(title=portal_type)
         # Write headers
-        instance = brains[0].getObject()
-        fields = self.get_fields(instance.schema)
+        instance = catalog.getobject(rids[0])
+        plan = self.get_plan(instance)
+        serializers = [serialize for fieldname, serialize in plan]
         headers = ['path', 'uid']
-        headers += [f.getName() for f in fields]
-        for col, header in enumerate(headers):
-            ws.cell(column=col + 1, row=1).value = header
+        headers += [fieldname for fieldname, serialize in plan]
+        sheet = self.get_sheet(portal_type, headers)
         # Write values
         portal_path = '/'.join(self.portal.getPhysicalPath())
-        for row, brain in enumerate(brains):
-            instance = brain.getObject()
-            # path
-            path = '/'.join(instance.getPhysicalPath()[:-1])
-            ws.cell(column=1, row=row + 2).value = \
-                path.replace(portal_path, '')
-            # uid
-            ws.cell(column=2, row=row + 2).value = instance.UID()
-            # then schema field values
-            for col, field in enumerate(fields):
-                value = self.mutate(instance, field)
-                ws.cell(column=col + 3, row=row + 2).value = value
-
+        batch_size = self.args.batch_size
+        for batch_start in range(0, len(rids), batch_size):
+            for rid in rids[batch_start:batch_start + batch_size]:
+                instance = catalog.getobject(rid)
+                # path
+                path = '/'.join(instance.getPhysicalPath()[:-1])
+                row = [path.replace(portal_path, '')]
+                # uid
+                row.append(instance.UID())
+                # then schema field values
+                row += [serialize(instance) for serialize in serializers]
+                sheet.append(row)
+                self.metrics.add('objects')
+                # Turn the object back into a ghost; nothing was modified.
+                aq_base(instance)._p_deactivate()
+            self.portal._p_jar.cacheMinimize()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -325,10 +1572,140 @@ if __name__ == '__main__':
         '-o',
         dest='outputfile',
         default='',
-        help='output zip file name (default: SITEPATH.zip)')
+        help='output zip file name, or - to write the archive to stdout'
+             ' (default: SITEPATH.zip)')
+    parser.add_argument(
+        '-f',
+        '--format',
+        dest='format',
+        choices=['xlsx', 'jsonl'],
+        default='xlsx',
+        help='format of the sheets: a single xlsx workbook, or one stream of'
+             ' JSON lines per sheet, which has no row limit and is faster to'
+             ' write and read (default: xlsx)')
+    parser.add_argument(
+        '--shard-rows',
+        dest='shard_rows',
+        type=int,
+        default=1000000,
+        help='sheets with more rows than this are split into several sheets,'
+             ' named SHEET_0001, SHEET_0002, ...; 0 never splits them'
+             ' (default: 1000000)')
+    parser.add_argument(
+        '--since',
+        dest='since',
+        default='',
+        help='previous archive created by this script; only objects'
+             ' modified since it was made are exported, along with a list of'
+             ' the objects deleted since then')
+    parser.add_argument(
+        '--include-type',
+        dest='include_types',
+        action='append',
+        default=[],
+        metavar='PORTAL_TYPE',
+        help='export only this portal_type, or Laboratory or BikaSetup; may'
+             ' be repeated')
+    parser.add_argument(
+        '--exclude-type',
+        dest='exclude_types',
+        action='append',
+        default=[],
+        metavar='PORTAL_TYPE',
+        help='do not export this portal_type, or Laboratory or BikaSetup;'
+             ' may be repeated')
+    parser.add_argument(
+        '--client',
+        dest='clients',
+        action='append',
+        default=[],
+        metavar='UID',
+        help='export only the client with this UID and its contents, and'
+             ' whatever --path selects; may be repeated')
+    parser.add_argument(
+        '--path',
+        dest='paths',
+        action='append',
+        default=[],
+        help='export only the objects at or below this path, relative to'
+             ' the site root, and whatever --client selects; may be'
+             ' repeated')
+    parser.add_argument(
+        '--closure',
+        dest='closure',
+        action='store_true',
+        help='also export the objects that the selected objects reference'
+             ' or are contained in, recursively, of any type that is not'
+             ' excluded with --exclude-type')
+    parser.add_argument(
+        '-j',
+        dest='jobs',
+        type=int,
+        default=1,
+        help='number of worker processes to export with (default: 1)')
+    parser.add_argument(
+        '--chunk-rows',
+        dest='chunk_rows',
+        type=int,
+        default=50000,
+        help='with -j, types with more objects than this are split between'
+             ' workers (default: 50000)')
+    parser.add_argument(
+        '--filestorage',
+        dest='filestorage',
+        default='',
+        help='with -j, FileStorage (Data.fs) for the workers to open'
+             ' read-only (default: the instance\'s main database)')
+    parser.add_argument(
+        '--blobstorage',
+        dest='blobstorage',
+        default='',
+        help='blob directory of the FileStorage given with --filestorage')
+    parser.add_argument(
+        '--compress-level',
+        dest='compress_level',
+        type=int,
+        default=6,
+        help='deflate level (1-9) for archive members that are not already'
+             ' compressed (default: 6)')
+    parser.add_argument(
+        '--compress-threads',
+        dest='compress_threads',
+        type=int,
+        default=4,
+        help='number of threads compressing large files (default: 4)')
+    parser.add_argument(
+        '--compress-threshold',
+        dest='compress_threshold',
+        type=int,
+        default=1 << 20,
+        help='files of at least this many bytes are compressed by the'
+             ' compression threads (default: 1048576)')
+    parser.add_argument(
+        '--metrics',
+        dest='metrics',
+        default='',
+        help='write the time, objects, catalog queries, file bytes and peak'
+             ' memory of each phase of the export to this JSON file')
+    parser.add_argument(
+        '--profile',
+        dest='profile',
+        default='',
+        help='profile each phase, and write the cProfile statistics of the'
+             ' slowest to this file')
+    parser.add_argument(
+        '--batch-size',
+        dest='batch_size',
+        type=int,
+        default=1000,
+        help='number of objects exported between ZODB cache minimizations'
+             ' (default: 1000)')
     args, unknown = parser.parse_known_args()
     if args.outputfile == '':
         args.outputfile = args.sitepath + ".zip"
+    if args.outputfile == '-':
+        # stdout carries the archive, so everything else goes to stderr
+        sys.stdout = sys.stderr
 
     main = Main(args)
     main()
@@ -1,19 +1,35 @@
 from AccessControl.SecurityManagement import newSecurityManager
 from Products.Archetypes import Field
 from Products.ATExtensions.ateapi import RecordField, RecordsField
+from Products.Archetypes.CatalogMultiplex import CatalogMultiplex
 from Products.CMFCore.utils import getToolByName
 from Products.CMFPlone.factory import _DEFAULT_PROFILE
 from Products.CMFPlone.factory import addPloneSite
+from zope.annotation.interfaces import IAnnotations
 
 import openpyxl
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+
+import Queue
 import argparse
+import cProfile
+import hashlib
+import json
 import os
 import pprint
+import resource
 import shutil
+import struct
+import sys
 import tempfile
+import threading
+import time
 import transaction
 import zipfile
+import zlib
 
 
 # def excepthook(typ, value, tb):
@@ -35,6 +51,16 @@ default_profiles = [
     'bika.lims:default',
 ]
 
+# Annotation in which upsert imports store the hashes of each object's row
+HASHES_KEY = 'bika.export_import.hashes'
+# Key of the hash of the whole row in the HASHES_KEY annotation
+ROW_HASH = ''
+# Number of rows handed to a preparing thread at a time
+PREPARE_BATCH = 100
+# Column of a _values sheet which holds, as JSON, the keys of a dictionary
+# that the sheet has no columns for
+OTHER_KEYS = '_other'
+
 export_types = [
     'Client',
     'Contact',
@@ -77,10 +103,375 @@ export_types = [
 ]
 
 
+def in_paths(path, prefixes):
+    """Return whether path is one of prefixes, or inside one of them.
+    """
+    for prefix in prefixes:
+        if path == prefix or path.startswith(prefix + '/'):
+            return True
+    return False
+
+
+class WorkbookReader:
+    """Forward-only access to the sheets of a read-only workbook.
+
+    Nothing is loaded when the workbook is opened; each call to iter_rows
+    makes a single streaming pass over one sheet.  shards lists the
+    (sheetname, shardnames) of sheets which the export split into several
+    shards; these are read as one sheet.
+    """
+
+    def __init__(self, filename, shards=()):
+        self.wb = openpyxl.load_workbook(filename, read_only=True)
+        self.shards = dict(shards)
+
+    def __contains__(self, sheetname):
+        return sheetname in self.wb.sheetnames
+
+    def close(self):
+        self.wb.close()
+
+    def get_shards(self, sheetname):
+        """Return the names of the shards of sheetname, in order.  Each
+        shard starts with the headers, and can be read on its own with
+        iter_shard_rows.
+        """
+        return self.shards.get(sheetname, [sheetname])
+
+    def iter_shard_rows(self, shardname):
+        """Yield the cell values of each row of a single shard as a list.
+        """
+        for row in self.wb[shardname].rows:
+            yield [cell.value for cell in row]
+
+    def iter_rows(self, sheetname):
+        """Yield the cell values of each row of sheetname as a list.  The
+        headers repeated at the top of later shards are skipped.
+        """
+        for nr, shardname in enumerate(self.get_shards(sheetname)):
+            rows = self.iter_shard_rows(shardname)
+            if nr:
+                next(rows, None)
+            for values in rows:
+                yield values
+
+    def iter_dicts(self, sheetname):
+        """Yield each row after the header row as a dict, keyed by the
+        values in the header row.
+        """
+        rows = self.iter_rows(sheetname)
+        keys = next(rows, [])
+        for values in rows:
+            if len(values) < len(keys):
+                values += [None] * (len(keys) - len(values))
+            yield dict(zip(keys, values))
+
+
+class JSONLReader(WorkbookReader):
+    """Forward-only access to sheets stored as JSON lines.
+
+    sheets maps each sheetname to the archive member holding it, as listed
+    in the manifest.  Each row is a JSON array on a line of its own.
+    """
+
+    def __init__(self, zf, sheets, shards=()):
+        self.zf = zf
+        self.sheets = OrderedDict()
+        self.shards = {}
+        self.update(sheets, shards)
+
+    def __contains__(self, sheetname):
+        return sheetname in self.sheets
+
+    def update(self, sheets, shards):
+        """Add sheets and shards which have arrived since this reader was
+        created.  shards replaces the shard lists of the sheets it names.
+        """
+        for sheetname, info in sheets:
+            self.sheets[sheetname] = info['member']
+        self.shards.update(dict(shards))
+
+    def close(self):
+        pass
+
+    def iter_shard_rows(self, shardname):
+        """Yield the values of each row of a single shard as a list.
+        """
+        fp = self.zf.open(self.sheets[shardname])
+        try:
+            for line in fp:
+                yield json.loads(line)
+        finally:
+            fp.close()
+
+
+class StreamReader:
+    """Sequential access to a zip file read from a stream that cannot seek,
+    such as stdin.
+
+    Iterating over the reader reads the members in the order they were
+    written, and yields the name of each one.  Every member is spooled to
+    a file in a temporary directory, so that it can then be opened by name
+    like a member of a ZipFile.  Members must have been written with their
+    sizes in the local header, as export_bika_setup.py does.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.spooldir = tempfile.mkdtemp()
+        self.NameToInfo = {}
+        self.filenames = {}
+
+    def __iter__(self):
+        while True:
+            fheader = self.fp.read(zipfile.sizeFileHeader)
+            # The central directory follows the last member
+            if fheader[:4] != zipfile.stringFileHeader:
+                break
+            fheader = struct.unpack(zipfile.structFileHeader, fheader)
+            filename = self.fp.read(fheader[zipfile._FH_FILENAME_LENGTH])
+            zinfo = zipfile.ZipInfo(filename)
+            zinfo.extra = self.fp.read(
+                fheader[zipfile._FH_EXTRA_FIELD_LENGTH])
+            zinfo.flag_bits = fheader[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS]
+            zinfo.compress_type = fheader[zipfile._FH_COMPRESSION_METHOD]
+            zinfo.CRC = fheader[zipfile._FH_CRC]
+            zinfo.compress_size = fheader[zipfile._FH_COMPRESSED_SIZE]
+            zinfo.file_size = fheader[zipfile._FH_UNCOMPRESSED_SIZE]
+            # Sizes too large for the header are in the zip64 extra field
+            zinfo._decodeExtra()
+            if zinfo.flag_bits & 0x08:
+                raise zipfile.BadZipfile(
+                    '%s was written without its size' % filename)
+            self.spool(zinfo)
+            yield filename
+        # Read the central directory, so that the writer is not cut off
+        while self.fp.read(1 << 16):
+            pass
+
+    def spool(self, zinfo):
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            dcmpr = zlib.decompressobj(-15)
+        elif zinfo.compress_type == zipfile.ZIP_STORED:
+            dcmpr = None
+        else:
+            raise zipfile.BadZipfile(
+                '%s uses an unsupported compression method' %
+                zinfo.filename)
+        filename = os.path.join(self.spooldir, str(len(self.filenames)))
+        crc = 0
+        with open(filename, 'wb') as out:
+            remaining = zinfo.compress_size
+            while remaining:
+                buf = self.fp.read(min(remaining, 1 << 16))
+                if not buf:
+                    raise zipfile.BadZipfile(
+                        'Stream ended inside %s' % zinfo.filename)
+                remaining -= len(buf)
+                if dcmpr:
+                    buf = dcmpr.decompress(buf)
+                crc = zlib.crc32(buf, crc)
+                out.write(buf)
+            if dcmpr:
+                buf = dcmpr.flush()
+                crc = zlib.crc32(buf, crc)
+                out.write(buf)
+        if crc & 0xffffffff != zinfo.CRC:
+            raise zipfile.BadZipfile(
+                'Bad CRC-32 for file %s' % zinfo.filename)
+        self.NameToInfo[zinfo.filename] = zinfo
+        self.filenames[zinfo.filename] = filename
+
+    def open(self, name):
+        return open(self.filenames[name], 'rb')
+
+    def read(self, name):
+        with self.open(name) as fp:
+            return fp.read()
+
+    def close(self):
+        shutil.rmtree(self.spooldir)
+
+
+class Metrics:
+    """Measurements of each phase of a run, written as JSON with --metrics.
+
+    A phase records its wall time, the objects it handled, the catalog
+    queries it made, the bytes of file data it moved, and the peak RSS of
+    the process when it ended.  Phases with the same name are added up.
+    With profile, every phase runs under cProfile, and the profile of the
+    slowest one is written to that file.
+    """
+
+    def __init__(self, filename='', profile=''):
+        self.filename = filename
+        self.profile = profile
+        self.started = time.time()
+        self.phases = OrderedDict()
+        self.current = None
+        self.slowest = None
+        # File bytes are counted by the threads that prepare rows
+        self.lock = threading.Lock()
+
+    def add(self, counter, value=1):
+        """Add value to a counter of the current phase.
+        """
+        with self.lock:
+            if self.current is not None:
+                self.current[counter] = self.current.get(counter, 0) + value
+
+    @contextmanager
+    def phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = {'seconds': 0.0, 'objects': 0,
+                                 'catalog_queries': 0, 'blob_bytes': 0}
+        outer, self.current = self.current, self.phases[name]
+        profiler = None
+        if self.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            if profiler:
+                profiler.disable()
+                if self.slowest is None or elapsed > self.slowest[1]:
+                    self.slowest = (name, elapsed)
+                    profiler.dump_stats(self.profile)
+            self.current['seconds'] += elapsed
+            self.current['peak_rss_mb'] = peak_rss()
+            self.current = outer
+
+    def write(self):
+        """Write the report to the --metrics file, if one was given.
+        """
+        if not self.filename:
+            return
+        phases = []
+        for name, phase in self.phases.items():
+            phase = dict(phase, name=name)
+            phase['objects_per_second'] = phase['objects'] / \
+                phase['seconds'] if phase['seconds'] else 0
+            phases.append(phase)
+        report = {
+            'started': self.started,
+            'seconds': time.time() - self.started,
+            'peak_rss_mb': peak_rss(),
+            'phases': phases,
+        }
+        if self.slowest:
+            report['profile'] = {'phase': self.slowest[0],
+                                 'filename': self.profile}
+        with open(self.filename, 'w') as fp:
+            json.dump(report, fp, indent=2)
+
+
+def peak_rss():
+    """Return the peak resident set size of this process, in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class SheetIndexCache:
+    """Lazily built lookup indexes over workbook sheets.
+
+    Each index is built with a single pass over its sheet, the first time
+    it is requested.  At most max_rows indexed rows are held in total; when
+    this is exceeded, the least recently used indexes are dropped, and they
+    will be rebuilt if they are requested again.  The indexes of the
+    working set, the sheets used by the type being imported, are never
+    dropped for each other: that would rebuild them row after row.  Indexes
+    may be requested by several threads; each is built only once.
+    """
+
+    def __init__(self, max_rows):
+        self.max_rows = max_rows
+        self.indexes = OrderedDict()
+        self.nr_rows = 0
+        self.working_set = frozenset()
+        self.lock = threading.Lock()
+
+    def set_working_set(self, keys):
+        """Keep the indexes stored under keys, dropping the others first
+        when there are more than max_rows indexed rows.
+        """
+        with self.lock:
+            self.working_set = frozenset(keys)
+            self.shrink()
+
+    def shrink(self, keep=None):
+        """Drop the least recently used indexes outside the working set,
+        other than keep, until at most max_rows rows are held.
+        """
+        for key in list(self.indexes):
+            if self.nr_rows <= self.max_rows:
+                break
+            if key != keep and key not in self.working_set:
+                self.nr_rows -= self.indexes.pop(key)[1]
+
+    def get(self, key, build):
+        """Return the index stored under key, calling build() to create it
+        if it is not cached.  build() must return (index, nr_rows).
+        """
+        with self.lock:
+            if key in self.indexes:
+                # move to the most recently used end
+                entry = self.indexes.pop(key)
+                self.indexes[key] = entry
+                return entry[0]
+            index, nr_rows = build()
+            self.indexes[key] = (index, nr_rows)
+            self.nr_rows += nr_rows
+            self.shrink(keep=key)
+            return index
+
+    def discard(self, key):
+        """Drop the index stored under key, if it is cached.
+        """
+        with self.lock:
+            if key in self.indexes:
+                self.nr_rows -= self.indexes.pop(key)[1]
+
+
+class PreparedBatch:
+    """Rows handed to a preparing thread, and their row plans once they
+    are ready; see Main.iter_row_plans.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.plans = None
+        self.error = None
+        self.ready = threading.Event()
+
+
 class Main:
     def __init__(self, args):
         self.args = args
         self.deferred = []
+        # {portal_type: {id: UID}} for every object that references may
+        # point to; see get_registry.
+        self.registry = {}
+        self.indexes = SheetIndexCache(args.index_rows)
+        self.schemas = None
+        self.setter_plans = {}
+        # {arcname: filename} of blobs extracted into blob_cache_dir
+        self.blob_cache = {}
+        self.blob_cache_dir = None
+        # Physical paths of objects created or modified in bulk mode, which
+        # still need to be cataloged; see index_touched.
+        self.touched = OrderedDict()
+        self.suppressed = {}
+        # Batched commits; see progress and commit.
+        self.batching = args.commit_every or args.commit_interval
+        self.nr_uncommitted = 0
+        self.last_commit = time.time()
+        self.checkpoint = {'completed': [], 'sheet': None, 'row': 0}
+        self.metrics = Metrics(args.metrics, args.profile)
+        # Paths selected by --client and --path; see get_scope_paths.
+        self.scope_paths = None
 
     def __call__(self):
         """Export entire bika site
@@ -92,35 +483,143 @@ class Main:
         try:
             self.portal = app.unrestrictedTraverse(self.args.sitepath)
         except KeyError:
+            if self.args.dry_run:
+                sys.exit('Error: %s not found.  A dry run checks the archive'
+                         ' against an existing site.' % self.args.sitepath)
             self.portal = self.create_site()
         setSite(self.portal)
-        # Extract zipfile
-        self.tempdir = tempfile.mkdtemp()
-        zf = zipfile.ZipFile(self.args.inputfile, 'r')
-        zf.extractall(self.tempdir)
-        # Open workbook
-        self.wb = openpyxl.load_workbook(
-            os.path.join(self.tempdir, 'setupdata.xlsx'))
+        self.scope_paths = self.get_scope_paths()
+        if self.args.dry_run:
+            return self.dry_run()
+        if self.args.bulk:
+            self.suppress_indexing()
+        if self.args.resume:
+            self.load_checkpoint()
+        self.blob_cache_dir = tempfile.mkdtemp()
+        if self.args.inputfile == '-':
+            self.import_stream()
+        else:
+            self.import_archive()
+        shutil.rmtree(self.blob_cache_dir)
+
+        # Resolve circular references
+        with self.metrics.phase('deferred'):
+            self.solve_deferred()
+
+        with self.metrics.phase('catalog'):
+            if self.args.bulk:
+                # Catalog only what this import has touched
+                self.restore_indexing()
+                self.index_touched()
+            else:
+                # Rebuild catalogs
+                for c in ['bika_analysis_catalog',
+                          'bika_catalog',
+                          'bika_setup_catalog',
+                          'portal_catalog']:
+                    print 'rebuilding %s' % c
+                    self.portal[c].clearFindAndRebuild()
+
+        with self.metrics.phase('commit'):
+            transaction.commit()
+        if self.batching and os.path.exists(self.args.checkpoint):
+            os.remove(self.args.checkpoint)
+        self.metrics.write()
+
+    def import_archive(self):
+        """Import the archive named with -i.
+        """
+        # Open zipfile; file field values are read from it as needed.
+        self.zf = zipfile.ZipFile(self.args.inputfile, 'r', allowZip64=True)
+        # Archives made with --since are applied on top of existing content
+        manifest = {}
+        if 'manifest.json' in self.zf.NameToInfo:
+            manifest = json.load(self.zf.open('manifest.json'))
+        self.read_manifest(manifest)
+        self.open_workbook()
         # Import
-        self.import_laboratory()
-        self.import_bika_setup()
-        for portal_type in export_types:
-            self.import_portal_type(portal_type)
-        # Remove tempdir
-        shutil.rmtree(self.tempdir)
-
-        # Resolve deferred/circular references
-        self.solve_deferred()
-
-        # Rebuild catalogs
-        for c in ['bika_analysis_catalog',
-                  'bika_catalog',
-                  'bika_setup_catalog',
-                  'portal_catalog']:
-            print 'rebuilding %s' % c
-            self.portal[c].clearFindAndRebuild()
+        self.import_setup()
+        for portal_type in self.plan_import(export_types):
+            with self.metrics.phase(portal_type):
+                self.import_portal_type(portal_type)
+        self.wb.close()
+        self.zf.close()
 
-        transaction.commit()
+    def import_stream(self):
+        """Import an archive from stdin, while export_bika_setup.py -o - is
+        still writing it.
+
+        Members are spooled to disk as they arrive.  In jsonl format, the
+        export writes a types/<portal_type>.json marker after the rows of
+        each type, and types are imported in dependency order as soon as
+        their markers have arrived.  Whatever is left is imported when the
+        stream ends.
+        """
+        self.zf = StreamReader(sys.stdin)
+        self.wb = None
+        plan = self.plan_import(export_types)
+        ready = set()
+        for name in self.zf:
+            if name == 'stream.json':
+                self.read_manifest(json.loads(self.zf.read(name)))
+                if self.manifest.get('format') == 'jsonl':
+                    self.open_workbook()
+            elif name.startswith('types/'):
+                marker = json.loads(self.zf.read(name))
+                self.wb.update(marker['sheets'], marker['shards'])
+                # Indexes of sheets that have grown must be rebuilt
+                for sheetname, info in marker['sheets']:
+                    self.indexes.discard(sheetname)
+                for sheetname, shardnames in marker['shards']:
+                    self.indexes.discard(sheetname)
+                portal_type = name[len('types/'):-len('.json')]
+                if portal_type == 'BikaSetup':
+                    self.import_setup()
+                ready.add(portal_type)
+                while plan and plan[0] in ready:
+                    portal_type = plan.pop(0)
+                    with self.metrics.phase(portal_type):
+                        self.import_portal_type(portal_type)
+        self.manifest = json.loads(self.zf.read('manifest.json'))
+        if self.wb is None:
+            self.open_workbook()
+        else:
+            self.wb.update(self.manifest['sheets'], self.manifest['shards'])
+            self.indexes = SheetIndexCache(self.args.index_rows)
+        # Steps that were already done are skipped
+        self.import_setup()
+        for portal_type in plan:
+            with self.metrics.phase(portal_type):
+                self.import_portal_type(portal_type)
+        self.wb.close()
+        self.zf.close()
+
+    def import_setup(self):
+        """Apply the tombstones, and import the laboratory and bika_setup.
+        """
+        with self.metrics.phase('Tombstones'):
+            self.apply_tombstones()
+        with self.metrics.phase('Laboratory'):
+            self.import_laboratory()
+        with self.metrics.phase('BikaSetup'):
+            self.import_bika_setup()
+
+    def read_manifest(self, manifest):
+        self.manifest = manifest
+        self.delta = bool(manifest.get('parent'))
+        if self.delta:
+            print 'Applying changes since %s' % manifest['parent']
+
+    def open_workbook(self):
+        shards = self.manifest.get('shards', [])
+        if self.manifest.get('format') == 'jsonl':
+            self.wb = JSONLReader(self.zf, self.manifest['sheets'], shards)
+        else:
+            # openpyxl is given the name of a file: sheets that are read at
+            # the same time would otherwise share, and garble, one file
+            # position.
+            self.wbfile = self.open_member('setupdata.xlsx', named=True)
+            self.wb = WorkbookReader(self.wbfile.name, shards)
 
     def create_site(self):
         profiles = default_profiles
@@ -138,222 +637,1245 @@ class Main:
         self.portal = app.unrestrictedTraverse(self.args.sitepath)
         return self.portal
 
+    def open_member(self, name, named=False):
+        """Return a temporary file holding the contents of a zip member.
+
+        The member is copied in chunks, and the file is removed as soon as it
+        is closed.  A real file object is returned, because that is what
+        the File field setters know how to consume.  With named, the file
+        has a name on disk with the extension of the member, which is what
+        openpyxl needs.
+        """
+        if named:
+            fp = tempfile.NamedTemporaryFile(
+                suffix=os.path.splitext(name)[1])
+        else:
+            fp = tempfile.TemporaryFile()
+        src = self.zf.open(name)
+        try:
+            shutil.copyfileobj(src, fp, 1 << 16)
+        finally:
+            src.close()
+        fp.seek(0)
+        return fp
+
+    def suppress_indexing(self):
+        """Replace CatalogMultiplex.indexObject and reindexObject with a
+        method that only records the object in self.touched.
+        """
+        main = self
+
+        def touch(obj, *args, **kwargs):
+            main.touch(obj)
+
+        for name in ('indexObject', 'reindexObject'):
+            self.suppressed[name] = CatalogMultiplex.__dict__[name]
+            setattr(CatalogMultiplex, name, touch)
+
+    def restore_indexing(self):
+        for name, method in self.suppressed.items():
+            setattr(CatalogMultiplex, name, method)
+        self.suppressed = {}
+
+    def touch(self, instance):
+        """Record that instance must be cataloged at the end of a bulk load.
+        """
+        if self.args.bulk:
+            self.touched[instance.getPhysicalPath()] = True
+
+    def index_touched(self):
+        """Catalog all touched objects, into the catalogs that their types
+        are mapped to in archetype_tool.
+        """
+        at = getToolByName(self.portal, 'archetype_tool')
+        catalogs = {}
+        nr_objects = len(self.touched)
+        print 'indexing %s objects' % nr_objects
+        for nr, path in enumerate(self.touched):
+            instance = self.portal.unrestrictedTraverse(path)
+            portal_type = instance.portal_type
+            if portal_type not in catalogs:
+                catalogs[portal_type] = at.getCatalogsByType(portal_type)
+            for catalog in catalogs[portal_type]:
+                catalog.catalog_object(instance, '/'.join(path))
+            self.metrics.add('objects')
+            if (nr + 1) % self.args.index_batch == 0:
+                transaction.savepoint(optimistic=True)
+                print 'indexed %s of %s objects' % (nr + 1, nr_objects)
+        self.touched.clear()
+
+    def load_checkpoint(self):
+        """Read the checkpoint left by an earlier, interrupted run.
+        """
+        if not os.path.exists(self.args.checkpoint):
+            print 'No checkpoint found at %s, starting from the beginning' % \
+                  self.args.checkpoint
+            return
+        with open(self.args.checkpoint) as fp:
+            self.checkpoint = json.load(fp)
+        self.deferred = self.checkpoint.pop('deferred')
+        for d in self.deferred:
+            d['path'] = d['path'].encode('utf-8')
+        print 'Resuming after %s row %s' % (
+            self.checkpoint['sheet'] or self.checkpoint['completed'][-1],
+            self.checkpoint['row'])
+
+    def save_checkpoint(self):
+        checkpoint = dict(self.checkpoint, deferred=self.deferred)
+        tmpname = self.args.checkpoint + '.tmp'
+        with open(tmpname, 'w') as fp:
+            json.dump(checkpoint, fp)
+        os.rename(tmpname, self.args.checkpoint)
+
+    def is_complete(self, sheetname):
+        """Return True if sheetname was fully committed by an earlier run.
+        """
+        return sheetname in self.checkpoint['completed']
+
+    def committed_rows(self, sheetname):
+        """Return the number of rows of sheetname that an earlier run has
+        committed.
+        """
+        if self.checkpoint['sheet'] == sheetname:
+            return self.checkpoint['row']
+        return 0
+
+    def progress(self, sheetname, rownr):
+        """Record that rownr rows of sheetname are done, and commit if the
+        current batch is full.
+        """
+        self.checkpoint['sheet'] = sheetname
+        self.checkpoint['row'] = rownr
+        if not self.batching:
+            return
+        self.nr_uncommitted += 1
+        if (self.args.commit_every
+                and self.nr_uncommitted >= self.args.commit_every) \
+                or (self.args.commit_interval
+                    and time.time() - self.last_commit
+                    >= self.args.commit_interval):
+            self.commit()
+
+    def complete(self, sheetname):
+        self.checkpoint['completed'].append(sheetname)
+        self.checkpoint['sheet'] = None
+        self.checkpoint['row'] = 0
+
+    def commit(self):
+        """Commit the current batch, write the checkpoint, and minimize the
+        ZODB cache.
+        """
+        if self.args.bulk:
+            self.index_touched()
+        transaction.commit()
+        self.save_checkpoint()
+        self.portal._p_jar.cacheMinimize()
+        print 'committed %s objects (%s row %s)' % (
+            self.nr_uncommitted, self.checkpoint['sheet'],
+            self.checkpoint['row'])
+        self.nr_uncommitted = 0
+        self.last_commit = time.time()
+
     def get_catalog(self, portal_type):
         """grab the first catalog we are indexed in
         """
         at = getToolByName(self.portal, 'archetype_tool')
         return at.getCatalogsByType(portal_type)[0]
 
+    def get_schemas(self):
+        """Return {portal_type: schema} for the types registered with
+        archetype_tool.  These are the class schemas, which instances share.
+        """
+        if self.schemas is None:
+            at = getToolByName(self.portal, 'archetype_tool')
+            self.schemas = dict((info['portal_type'], info['schema'])
+                                for info in at.listRegisteredTypes())
+        return self.schemas
+
+    def get_type_dependencies(self, portal_types):
+        """Return ({portal_type: [types that may contain it]},
+        {portal_type: [types it references]}) for portal_types.
+
+        Containers must be imported before their contents, or the parents
+        do not exist.  References are only a preference: a reference to
+        a type that comes later is deferred, and linked by solve_deferred.
+        """
+        pt = getToolByName(self.portal, 'portal_types')
+        schemas = self.get_schemas()
+        containers = dict((portal_type, []) for portal_type in portal_types)
+        references = dict((portal_type, []) for portal_type in portal_types)
+        for portal_type in portal_types:
+            if portal_type not in pt:
+                continue
+            for child in pt[portal_type].allowed_content_types:
+                if child in containers and child != portal_type:
+                    containers[child].append(portal_type)
+        for portal_type in portal_types:
+            schema = schemas.get(portal_type)
+            if schema is None:
+                continue
+            for field in schema.fields():
+                if not Field.IReferenceField.providedBy(field):
+                    continue
+                allowed_types = field.allowed_types
+                if isinstance(allowed_types, basestring):
+                    allowed_types = [allowed_types]
+                for target_type in allowed_types or []:
+                    if target_type in references \
+                            and target_type != portal_type \
+                            and target_type not in references[portal_type]:
+                        references[portal_type].append(target_type)
+        return containers, references
+
+    def plan_import(self, portal_types):
+        """Return portal_types in dependency order.
+
+        This is a depth-first topological sort which otherwise keeps the
+        order of portal_types.  Every type comes after the types that may
+        contain it.  It also comes after the types it references, except
+        where that would put a type before one of its containers: where
+        types reference each other in a cycle, the reference that closes
+        the cycle is left out here, and its values are deferred and linked
+        by solve_deferred.
+        """
+        containers, references = self.get_type_dependencies(portal_types)
+        # {portal_type: the types it needs, by containment, transitively}
+        required = {}
+
+        def get_required(portal_type, seen=()):
+            if portal_type not in required:
+                found = set()
+                for container in containers[portal_type]:
+                    if container not in seen:
+                        found.add(container)
+                        found.update(get_required(
+                            container, seen + (portal_type,)))
+                required[portal_type] = found
+            return required[portal_type]
+
+        order = []
+        visiting = set()
+
+        def visit(portal_type):
+            if portal_type in order or portal_type in visiting:
+                return
+            visiting.add(portal_type)
+            for container in containers[portal_type]:
+                visit(container)
+            for target_type in references[portal_type]:
+                # A type in visiting is placed after this one, so neither
+                # it nor its containers may be placed before.
+                if target_type in visiting or \
+                        get_required(target_type) & visiting:
+                    continue
+                visit(target_type)
+            visiting.remove(portal_type)
+            order.append(portal_type)
+
+        for portal_type in portal_types:
+            visit(portal_type)
+        return order
+
+    def is_included(self, portal_type):
+        """Return whether --include-type and --exclude-type select
+        portal_type.
+        """
+        if self.args.include_types \
+                and portal_type not in self.args.include_types:
+            return False
+        return portal_type not in self.args.exclude_types
+
+    def get_scope_paths(self):
+        """Return the paths, relative to the site, of --path prefixes and of
+        the --client clients that already exist in the site, or None if
+        neither option is given.  Clients that are in the archive are added
+        by in_scope as their rows are read.
+        """
+        if not self.args.clients and not self.args.paths:
+            return None
+        paths = [path.strip('/') for path in self.args.paths]
+        rc = getToolByName(self.portal, 'reference_catalog')
+        portal_path = self.portal.getPhysicalPath()
+        for uid in self.args.clients:
+            client = rc.lookupObject(uid)
+            self.metrics.add('catalog_queries')
+            if client is not None:
+                paths.append('/'.join(
+                    client.getPhysicalPath()[len(portal_path):]))
+        return paths
+
+    def in_scope(self, portal_type, path, instance_id, uid):
+        """Return whether the filter options select the row of an object.
+        path is the path of its parent, relative to the site.
+        """
+        if not self.is_included(portal_type):
+            return False
+        if self.scope_paths is None:
+            return True
+        path = '%s/%s' % (path, instance_id) if path else instance_id
+        if portal_type == 'Client' and uid in self.args.clients:
+            # The contents of the client follow it
+            self.scope_paths.append(path)
+            return True
+        return in_paths(path, self.scope_paths)
+
+    def includes_settings(self, sheetname, path):
+        """Return whether the Laboratory or BikaSetup sheet is in scope.
+        """
+        if sheetname not in self.wb or not self.is_included(sheetname):
+            return False
+        return self.scope_paths is None or in_paths(path, self.scope_paths)
+
+    def get_type_cycles(self, portal_types):
+        """Return the groups of portal_types which depend on each other in
+        a cycle, each in plan order.  References between the types of a
+        group cannot all be set as rows are imported, and some are left
+        to solve_deferred.  Containment alone does not make a cycle: types
+        that only contain each other cannot be imported at all.
+        """
+        containers, references = self.get_type_dependencies(portal_types)
+        deps = dict((portal_type, containers[portal_type] +
+                     references[portal_type])
+                    for portal_type in portal_types)
+        # Tarjan's strongly connected components
+        index = {}
+        lowlink = {}
+        stack = []
+        cycles = []
+
+        def visit(portal_type):
+            index[portal_type] = lowlink[portal_type] = len(index)
+            stack.append(portal_type)
+            for dep in deps[portal_type]:
+                if dep not in index:
+                    visit(dep)
+                    lowlink[portal_type] = min(lowlink[portal_type],
+                                               lowlink[dep])
+                elif dep in stack:
+                    lowlink[portal_type] = min(lowlink[portal_type],
+                                               index[dep])
+            if lowlink[portal_type] == index[portal_type]:
+                group = []
+                while True:
+                    member = stack.pop()
+                    group.append(member)
+                    if member == portal_type:
+                        break
+                if any(target_type in group
+                       for member in group
+                       for target_type in references[member]):
+                    cycles.append(group)
+
+        for portal_type in portal_types:
+            if portal_type not in index:
+                visit(portal_type)
+        order = self.plan_import(portal_types)
+        return [sorted(group, key=order.index) for group in cycles]
+
+    def get_registry(self, portal_type):
+        """Return the {id: UID} registry for portal_type.
+
+        The first time a type is requested, the registry is seeded with the
+        objects that already exist in the site, from catalog metadata; objects
+        created by this import are added to it by import_portal_type.
+        """
+        if portal_type not in self.registry:
+            ids = {}
+            catalog = self.get_catalog(portal_type)
+            self.metrics.add('catalog_queries')
+            for brain in catalog(portal_type=portal_type):
+                ids.setdefault(brain.getId, brain.UID)
+            self.registry[portal_type] = ids
+        return self.registry[portal_type]
+
+    def lookup(self, allowed_types, target_id):
+        """Return the UID of the object with id target_id, of any of the
+        allowed_types, or None if it is not known.
+        """
+        if isinstance(allowed_types, basestring):
+            allowed_types = [allowed_types]
+        for portal_type in allowed_types:
+            uid = self.get_registry(portal_type).get(target_id)
+            if uid:
+                return uid
+        return None
+
     def resolve_reference_ids_to_uids(self, instance, field, value):
         """Get target UIDs for any ReferenceField.
         If targets do not exist, the requirement is added to deferred.
         """
-        # We make an assumption here, that if there are multiple allowed
-        # types, they will all be indexed in the same catalog.
-        target_type = field.allowed_types \
-            if isinstance(field.allowed_types, basestring) \
-            else field.allowed_types[0]
-        catalog = self.get_catalog(target_type)
         # The ID is what is stored in the export, so first we must grab these:
         if field.multiValued:
             # multiValued references get their values stored in a sheet
             # named after the relationship.
-            ids = []
-            if field.relationship[:31] not in self.wb:
+            sheetname = field.relationship[:31]
+            if sheetname not in self.wb:
                 return None
-            ws = self.wb[field.relationship[:31]]
-            ids = []
-            for rownr, row in enumerate(ws.rows):
-                if rownr == 0:
-                    keys = [cell.value for cell in row]
-                    continue
-                rowdict = dict(zip(keys, [cell.value for cell in row]))
-                if rowdict['Source'] == instance.id:
-                    ids.append(rowdict['Target'])
+            ids = self.get_relationship_index(sheetname).get(instance.id)
             if not ids:
                 return []
             final_value = []
             for vid in ids:
-                brain = catalog(portal_type=field.allowed_types, id=vid)
-                if brain:
-                    final_value.append(brain[0].getObject())
+                uid = self.lookup(field.allowed_types, vid)
+                if uid:
+                    final_value.append(uid)
                 else:
-                    self.defer(instance, field, catalog,
-                               field.allowed_types, vid)
+                    self.defer(instance, field, field.allowed_types, vid)
             return final_value
         else:
             if value:
-                brain = catalog(portal_type=field.allowed_types, id=value)
-                if brain:
-                    return brain[0].getObject()
+                uid = self.lookup(field.allowed_types, value)
+                if uid:
+                    return uid
                 else:
-                    self.defer(instance, field, catalog,
-                               field.allowed_types, value)
+                    self.defer(instance, field, field.allowed_types, value)
         return None
 
-    def resolve_records(self, instance, field, value):
+    def get_relationship_index(self, sheetname):
+        """Return the {Source: [Target, ...]} index for a relationship sheet.
+        """
+        return self.indexes.get(
+            sheetname, lambda: self.build_relationship_index(sheetname))
+
+    def build_relationship_index(self, sheetname):
+        index = {}
+        nr_rows = 0
+        for rowdict in self.wb.iter_dicts(sheetname):
+            index.setdefault(rowdict['Source'], []).append(rowdict['Target'])
+            nr_rows += 1
+        return index, nr_rows
+
+    def resolve_records(self, instance_id, field, value):
         # RecordField and RecordsField
         # We must re-create the dict (or list of dicts) from sheet values
-        ws = self.wb[value]
-        matches = []
-        for rownr, row in enumerate(ws.rows):
-            if rownr == 0:
-                keys = [cell.value for cell in row]
-                continue
-            rowdict = dict(zip(keys, [cell.value for cell in row]))
-            if rowdict['id'] == instance.id \
-                    and rowdict['field'] == field.getName():
-                matches.append(rowdict)
+        index = self.get_records_index(value)
+        matches = index.get((instance_id, field.getName()), [])
         if type(field.default) == dict:
             return matches[0] if matches else {}
         else:
             return matches
 
-    def set(self, instance, field, value):
-        # mutator = field.getMutator(instance)
-        outval = self.mutate(instance, field, value)
-        if field.getName() == 'id':
-            # I don't know why, but if we use field.set for setting the id, it
-            # lands in the database as a unicode string causing catalog failure
-            instance.id = outval
-        else:
-            field.set(instance, outval)
+    def get_records_sheets(self, field):
+        """Return the names of the sheets which may hold the dictionaries of
+        a field: the sheet of the field, and the sheet of its field type,
+        which archives of older exports share between fields.
+        """
+        return [sheetname for sheetname in (
+            ('%s_values' % field.getName())[:31],
+            ('%s_values' % field.type)[:31]) if sheetname in self.wb]
 
-    def mutate(self, instance, field, value):
-        # Ints and bools are transparent
-        if type(value) in (int, bool):
-            return value
-        # All strings must be encoded
-        if isinstance(value, unicode):
-            value = value.encode('utf-8')
+    def get_index_sheets(self, schema, keys):
+        """Return the names of the lookup sheets which the field columns of
+        a sheet with header keys are read from.
+        """
+        sheetnames = set()
+        for fieldname in keys:
+            field = schema.get(fieldname)
+            if field is None:
+                continue
+            sheetnames.update(self.get_records_sheets(field))
+            if Field.IReferenceField.providedBy(field) and field.multiValued:
+                sheetnames.add(field.relationship[:31])
+        return sheetnames
+
+    def get_records_index(self, sheetname):
+        """Return the {(id, field): [rowdict, ...]} index for a _values sheet.
+        """
+        return self.indexes.get(
+            sheetname, lambda: self.build_records_index(sheetname))
+
+    def build_records_index(self, sheetname):
+        index = {}
+        nr_rows = 0
+        for rowdict in self.wb.iter_dicts(sheetname):
+            other = rowdict.pop(OTHER_KEYS, None)
+            if other:
+                rowdict.update(json.loads(other))
+            key = (rowdict['id'], rowdict['field'])
+            index.setdefault(key, []).append(rowdict)
+            nr_rows += 1
+        return index, nr_rows
+
+    def set(self, instance, field, value):
+        value = self.compile_prepare(field)(instance.id, value)
+        self.compile_setter(field)(instance, value)
 
+    def convert_record(self, instance_id, field, value):
         # RecordField is a single dictionary from the lookup table
-        if isinstance(field, RecordField):
-            value = self.resolve_records(instance, field, value) \
-                if value else {}
+        return self.resolve_records(instance_id, field, value) if value \
+            else {}
+
+    def convert_records(self, instance_id, field, value):
         # RecordsField is a list of dictionaries from the lookup table
-        elif isinstance(field, RecordsField) or \
-                (isinstance(value, basestring)
-                 and value
-                 and value.endswith('_values')):
-            value = self.resolve_records(instance, field, value) \
-                if value else []
+        return self.resolve_records(instance_id, field, value) if value \
+            else []
 
-        # ReferenceField looks up single ID from cell value, or multiple
-        # IDs from a lookup table
-        if Field.IReferenceField.providedBy(field):
-            value = self.resolve_reference_ids_to_uids(instance, field, value)
+    def convert_lines(self, instance_id, field, value):
         # LinesField was converted to a multiline string on export
+        return value.splitlines() if value else ()
+
+    def convert_file(self, instance_id, field, value):
+        """Return the file named in a cell, as (function which opens the
+        file, kwargs for field.set).
+
+        Rows wait in the read-ahead queue of iter_row_plans after they are
+        prepared, so the file is only opened by the setter, in the writing
+        thread, and closed as soon as it is set.  Content-addressed files
+        are extracted here, into the blob cache.
+        """
+        if not value:
+            return value
+        if value.startswith('blobs/') and '|' in value:
+            # Content-addressed file: "blobs/<sha1>|content type|filename"
+            arcname, content_type, filename = value.split('|', 2)
+            if arcname not in self.zf.NameToInfo:
+                print "Expected file does not exist: " + arcname
+                return ''
+            self.metrics.add('blob_bytes',
+                             self.zf.NameToInfo[arcname].file_size)
+            return (partial(open, self.extract_blob(arcname), 'rb'),
+                    {'filename': filename, 'mimetype': content_type})
+        if value not in self.zf.NameToInfo:
+            print "Expected file does not exist: " + value
+            return ''
+        self.metrics.add('blob_bytes', self.zf.NameToInfo[value].file_size)
+        return (partial(self.open_member, value), {})
+
+    def extract_blob(self, arcname):
+        """Return the name of a file holding the contents of a
+        content-addressed member.
+
+        The same blob may be used by many objects, so each one is extracted
+        only once, into the blob cache directory, and reopened from there.
+        Preparing threads may extract the same blob at the same time; each
+        writes its own file, and renames it into place when it is complete.
+        """
+        if arcname not in self.blob_cache:
+            filename = os.path.join(self.blob_cache_dir,
+                                    arcname.replace('/', '-'))
+            fd, partial = tempfile.mkstemp(dir=self.blob_cache_dir)
+            src = self.zf.open(arcname)
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    shutil.copyfileobj(src, fp, 1 << 16)
+            finally:
+                src.close()
+            os.rename(partial, filename)
+            self.blob_cache[arcname] = filename
+        return self.blob_cache[arcname]
+
+    def compile_prepare(self, field):
+        """Return a function of (instance_id, cell value) which converts the
+        value as far as that can be done without the site: strings are
+        encoded, and records, lines and files are read from their sheets
+        and members.  All the checks on the field's type are made once,
+        here, rather than once for every cell.  The function may run in a
+        preparing thread; see iter_row_plans.
+        """
+        converters = []
+        if isinstance(field, RecordField):
+            converters.append(self.convert_record)
+        elif isinstance(field, RecordsField):
+            converters.append(self.convert_records)
+        else:
+            # Other fields that held dictionaries on export have their
+            # values in a records sheet, and the cell contains the name of
+            # that sheet.
+            records_sheets = self.get_records_sheets(field)
+            if records_sheets:
+                def convert_records_sheet(instance_id, field, value):
+                    if value in records_sheets:
+                        return self.convert_records(instance_id, field, value)
+                    return value
+                converters.append(convert_records_sheet)
         if Field.ILinesField.providedBy(field):
-            value = value.splitlines() if value else ()
-        # XXX THis should not be reading entire file contents into mem.
+            converters.append(self.convert_lines)
         # TextField provides the IFileField interface, these must be ignored.
-        elif value and Field.IFileField.providedBy(field) \
+        elif Field.IFileField.providedBy(field) \
                 and not Field.ITextField.providedBy(field):
-            if not os.path.exists(os.path.join(self.tempdir, value)):
-                print "Expected file does not exist: " + value
-                return ''
-            value = open(os.path.join(self.tempdir, value)).read()
-        return value
+            converters.append(self.convert_file)
+
+        def prepare(instance_id, value):
+            # Ints and bools are transparent
+            if type(value) in (int, bool):
+                return value
+            # All strings must be encoded
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            for convert in converters:
+                value = convert(instance_id, field, value)
+            return value
+
+        return prepare
+
+    def compile_setter(self, field):
+        """Return a function which sets a value returned by the field's
+        compile_prepare function as the value of field on an instance.
+        References are resolved here, in the writing thread, because their
+        targets may be the objects created by the rows before.
+        """
+        # ReferenceField looks up single ID from cell value, or multiple
+        # IDs from a lookup table
+        is_reference = Field.IReferenceField.providedBy(field)
+        # convert_file returns an opener for the file with its name and
+        # type, as a tuple
+        is_file = Field.IFileField.providedBy(field) \
+            and not Field.ITextField.providedBy(field)
+        is_id = field.getName() == 'id'
+
+        def setter(instance, value):
+            kwargs = {}
+            if is_reference and type(value) not in (int, bool):
+                value = self.resolve_reference_ids_to_uids(
+                    instance, field, value)
+            if is_file and type(value) is tuple:
+                open_file, kwargs = value
+                fp = open_file()
+                try:
+                    field.set(instance, fp, **kwargs)
+                finally:
+                    fp.close()
+            elif is_id:
+                # I don't know why, but if we use field.set for setting the
+                # id, it lands in the database as a unicode string causing
+                # catalog failure
+                instance.id = value
+            else:
+                field.set(instance, value, **kwargs)
+
+        return setter
+
+    def compile_fingerprint(self, field):
+        """Return a function of (instance_id, cell value) which returns a
+        string that changes whenever the value that the field would be set
+        to changes.  For values kept in lookup sheets or zip members, the
+        cell value alone does not tell us that.
+        """
+        if isinstance(field, (RecordField, RecordsField)) \
+                or self.get_records_sheets(field):
+            fieldname = field.getName()
+
+            def fingerprint(instance_id, value):
+                if not value or value not in self.wb:
+                    return repr(value)
+                matches = self.get_records_index(value).get(
+                    (instance_id, fieldname), [])
+                return repr([sorted(match.items()) for match in matches])
+        elif Field.IReferenceField.providedBy(field) and field.multiValued:
+            sheetname = field.relationship[:31]
+
+            def fingerprint(instance_id, value):
+                if sheetname not in self.wb:
+                    return ''
+                return repr(self.get_relationship_index(sheetname).get(
+                    instance_id))
+        elif Field.IFileField.providedBy(field) \
+                and not Field.ITextField.providedBy(field):
+            def fingerprint(instance_id, value):
+                zinfo = self.zf.NameToInfo.get(value)
+                if zinfo is None:
+                    return repr(value)
+                return '%r:%s:%s' % (value, zinfo.CRC, zinfo.file_size)
+        else:
+            def fingerprint(instance_id, value):
+                return repr(value)
+        return fingerprint
+
+    def get_setter_plan(self, portal_type, schema, keys):
+        """Return [(column, fieldname, prepare, setter, fingerprint), ...]
+        for the field columns of a sheet with header keys.  Plans are
+        compiled once for each portal_type and header.
+        """
+        plan_key = (portal_type, tuple(keys))
+        if plan_key not in self.setter_plans:
+            self.setter_plans[plan_key] = [
+                (col, fieldname,
+                 self.compile_prepare(schema[fieldname]),
+                 self.compile_setter(schema[fieldname]),
+                 self.compile_fingerprint(schema[fieldname]))
+                for col, fieldname in enumerate(keys)
+                if fieldname not in ('path', 'uid', 'id', 'title')]
+        return self.setter_plans[plan_key]
+
+    def find_existing(self, parent, instance_id, uid):
+        """Return the existing object with the exported UID, or else the
+        one at the exported path and id, or None.
+        """
+        instance = None
+        if uid:
+            rc = getToolByName(self.portal, 'reference_catalog')
+            instance = rc.lookupObject(uid)
+            self.metrics.add('catalog_queries')
+        if instance is None:
+            instance = parent._getOb(instance_id, None)
+        return instance
+
+    def row_hashes(self, instance_id, title, values, plan):
+        """Return {fieldname: hash} for the title and field values of a row,
+        with the hash of the whole row under ROW_HASH.
+        """
+        hashes = {'title': hashlib.sha1(title).hexdigest()}
+        for col, fieldname, prepare, setter, fingerprint in plan:
+            hashes[fieldname] = hashlib.sha1(
+                fingerprint(instance_id, values[col])).hexdigest()
+        hashes[ROW_HASH] = hashlib.sha1(
+            ''.join(hashes[key] for key in sorted(hashes))).hexdigest()
+        return hashes
 
     def import_laboratory(self):
+        if self.is_complete('Laboratory') \
+                or not self.includes_settings('Laboratory',
+                                              'bika_setup/laboratory'):
+            return
         instance = self.portal.bika_setup.laboratory
         schema = instance.schema
-        ws = self.wb['Laboratory']
-        for row in ws.rows:
-            fieldname = row[0].value
-            cellvalue = row[1].value
+        for row in self.wb.iter_rows('Laboratory'):
+            fieldname = row[0]
+            cellvalue = row[1] if len(row) > 1 else None
             field = schema[fieldname]
             self.set(instance, field, cellvalue)
+        self.touch(instance)
+        self.complete('Laboratory')
 
     def import_bika_setup(self):
+        if self.is_complete('BikaSetup') \
+                or not self.includes_settings('BikaSetup', 'bika_setup'):
+            return
         instance = self.portal.bika_setup
         schema = instance.schema
-        ws = self.wb['BikaSetup']
-        for row in ws.rows:
-            fieldname = row[0].value
-            cellvalue = row[1].value
+        for row in self.wb.iter_rows('BikaSetup'):
+            fieldname = row[0]
+            cellvalue = row[1] if len(row) > 1 else None
             field = schema[fieldname]
             self.set(instance, field, cellvalue)
+        self.touch(instance)
+        self.complete('BikaSetup')
 
     def import_portal_type(self, portal_type):
-        if portal_type not in self.wb:
+        if portal_type not in self.wb or self.is_complete(portal_type) \
+                or not self.is_included(portal_type):
             return None
         pt = getToolByName(self.portal, 'portal_types')
-        if portal_type not in pt:
+        schema = self.get_schemas().get(portal_type)
+        if portal_type not in pt or schema is None:
             print 'Error: %s not found in portal_types.' % portal_type
             return None
         fti = pt[portal_type]
-        ws = self.wb[portal_type]
-        keys = [cell.value for cell in ws.rows[0]]
-        for rownr, row in enumerate(ws.rows[1:]):
-            rowdict = dict(zip(keys, [cell.value for cell in row]))
-            # First, some fields we manually extract, to prevent them
-            # from being handled by the loop below:
-            path = rowdict['path'].encode('utf-8').strip('/').split('/')
-            del (rowdict['path'])
-            uid = rowdict['uid'].encode('utf-8')
-            del (rowdict['uid'])
-            instance_id = rowdict['id'].encode('utf-8')
-            del (rowdict['id'])
-            # We need to get 'title', for the case of aberrations with no value
-            # it's really required, so we use the ID in these cases.
-            title = rowdict['title'].encode('utf-8') if rowdict['title'] \
-                else instance_id
-            del (rowdict['title'])
-
+        skip = self.committed_rows(portal_type)
+        rows = self.wb.iter_rows(portal_type)
+        keys = next(rows, [])
+        plan = self.get_setter_plan(portal_type, schema, keys)
+        self.indexes.set_working_set(self.get_index_sheets(schema, keys))
+        for rownr, path, instance_id, title, uid, values, hashes \
+                in self.iter_row_plans(portal_type, keys, rows, plan, skip):
+            if path is None:
+                # The row is not in scope
+                self.progress(portal_type, rownr + 1)
+                continue
             parent = self.portal.unrestrictedTraverse(path)
-            instance = fti.constructInstance(parent, instance_id, title=title)
-            instance.unmarkCreationFlag()
+            instance = None
+            if self.delta or self.args.upsert:
+                # Objects that already exist are updated
+                instance = self.find_existing(parent, instance_id, uid)
+            created = instance is None
+            if created:
+                instance = fti.constructInstance(
+                    parent, instance_id, title=title)
+                instance.unmarkCreationFlag()
+            self.get_registry(portal_type)[instance_id] = instance.UID()
+            old_hashes = None
+            if self.args.upsert:
+                # Only fields whose values have changed since the last
+                # upsert of this object are set, and unchanged rows are
+                # skipped altogether.
+                old_hashes = {} if created else \
+                    IAnnotations(instance).get(HASHES_KEY, {})
+                if old_hashes.get(ROW_HASH) == hashes[ROW_HASH]:
+                    self.progress(portal_type, rownr + 1)
+                    continue
+            if not created and (old_hashes is None
+                                or old_hashes.get('title') != hashes['title']):
+                instance.setTitle(title)
+            for (col, fieldname, prepare, setter, fingerprint), value \
+                    in zip(plan, values):
+                if old_hashes is None \
+                        or old_hashes.get(fieldname) != hashes[fieldname]:
+                    setter(instance, value)
+            if hashes:
+                IAnnotations(instance)[HASHES_KEY] = hashes
             instance.reindexObject()
-            for fieldname, value in rowdict.items():
-                field = instance.schema[fieldname]
-                self.set(instance, field, value)
+            self.touch(instance)
+            self.metrics.add('objects')
+            self.progress(portal_type, rownr + 1)
+        self.complete(portal_type)
+
+    def iter_scoped_rows(self, portal_type, keys, rows, skip):
+        """Yield (rownr, values, path, instance_id) for the rows of a type
+        sheet after the first skip rows.  path is None for rows that are
+        not in scope.
+        """
+        path_col = keys.index('path')
+        uid_col = keys.index('uid')
+        id_col = keys.index('id')
+        for rownr, values in enumerate(rows):
+            if rownr < skip:
+                continue
+            if len(values) < len(keys):
+                values += [None] * (len(keys) - len(values))
+            path = values[path_col].encode('utf-8').strip('/').split('/')
+            instance_id = values[id_col].encode('utf-8')
+            if self.scope_paths is not None and not self.in_scope(
+                    portal_type, '/'.join(path), instance_id,
+                    values[uid_col]):
+                path = None
+            yield rownr, values, path, instance_id
+
+    def iter_row_plans(self, portal_type, keys, rows, plan, skip):
+        """Yield (rownr, path, instance_id, title, uid, values, hashes) for
+        the rows of a type sheet, in order.  values are the cells of the
+        field columns of plan, converted by their prepare functions, and
+        hashes are the row_hashes of an upsert.
+
+        The rows are read by a reader thread, which hands them in batches
+        to --prepare-threads threads.  These encode the cells, look up
+        records, extract files and compute hashes while the rows before
+        are being written, and the writing thread only has to construct
+        objects, resolve references and set fields.  At most
+        --prepare-rows rows are read ahead, so that memory stays bounded
+        however large the sheet is.
+        """
+        uid_col = keys.index('uid')
+        title_col = keys.index('title')
+
+        def prepare_row(rownr, values, path, instance_id):
+            if path is None:
+                return rownr, None, instance_id, None, None, None, None
+            uid = values[uid_col].encode('utf-8') if values[uid_col] \
+                else None
+            # We need to get 'title', for the case of aberrations with no
+            # value it's really required, so we use the ID in these cases.
+            title = values[title_col].encode('utf-8') if values[title_col] \
+                else instance_id
+            hashes = None
+            if self.args.upsert:
+                hashes = self.row_hashes(instance_id, title, values, plan)
+            prepared = [prepare(instance_id, values[col])
+                        for col, fieldname, prepare, setter, fingerprint
+                        in plan]
+            return rownr, path, instance_id, title, uid, prepared, hashes
+
+        scoped = self.iter_scoped_rows(portal_type, keys, rows, skip)
+        if self.args.prepare_threads < 1:
+            for row in scoped:
+                yield prepare_row(*row)
+            return
 
-    def defer(self, instance, field, catalog, allowed_types, target_id):
+        batches = Queue.Queue(max(1, self.args.prepare_rows // PREPARE_BATCH))
+        work = Queue.Queue()
+        stop = threading.Event()
+
+        def put(batch):
+            # Wait for room in the queue, unless the writer has stopped
+            while not stop.is_set():
+                try:
+                    batches.put(batch, timeout=1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def read():
+            try:
+                rows = []
+                for row in scoped:
+                    rows.append(row)
+                    if len(rows) == PREPARE_BATCH:
+                        batch = PreparedBatch(rows)
+                        put(batch)
+                        work.put(batch)
+                        rows = []
+                        if stop.is_set():
+                            return
+                if rows:
+                    batch = PreparedBatch(rows)
+                    put(batch)
+                    work.put(batch)
+            except Exception:
+                batch = PreparedBatch([])
+                batch.error = sys.exc_info()
+                batch.ready.set()
+                put(batch)
+            finally:
+                put(None)
+                for i in range(self.args.prepare_threads):
+                    work.put(None)
+
+        def prepare():
+            while True:
+                batch = work.get()
+                if batch is None:
+                    return
+                try:
+                    batch.plans = [prepare_row(*row) for row in batch.rows]
+                except Exception:
+                    batch.error = sys.exc_info()
+                batch.rows = None
+                batch.ready.set()
+
+        threads = [threading.Thread(target=prepare)
+                   for i in range(self.args.prepare_threads)]
+        threads.append(threading.Thread(target=read))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                # Waiting with a timeout lets KeyboardInterrupt through
+                while not batch.ready.wait(1):
+                    pass
+                if batch.error:
+                    raise batch.error[0], batch.error[1], batch.error[2]
+                for row_plan in batch.plans:
+                    yield row_plan
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def apply_tombstones(self):
+        """Delete the objects listed in the Tombstones sheet of a delta.
+
+        This is done before any rows are imported, in case an object was
+        deleted and another created with the same id.
+        """
+        if 'Tombstones' not in self.wb or self.is_complete('Tombstones'):
+            return
+        for rowdict in self.wb.iter_dicts('Tombstones'):
+            path = rowdict['path'].encode('utf-8').strip('/').split('/')
+            instance_id = path.pop()
+            if not self.in_scope(rowdict['portal_type'], '/'.join(path),
+                                 instance_id, rowdict['uid']):
+                continue
+            parent = self.portal.unrestrictedTraverse(path, None)
+            if parent is None or parent._getOb(instance_id, None) is None:
+                continue
+            parent.manage_delObjects([instance_id])
+            self.metrics.add('objects')
+            self.get_registry(rowdict['portal_type']).pop(instance_id, None)
+        self.complete('Tombstones')
+
+    def defer(self, instance, field, allowed_types, target_id):
+        # Deferred references are stored by path and field name, so that
+        # they can be written to the checkpoint.
         self.deferred.append({
-            'instance': instance,
-            'field': field,
-            'catalog': catalog,
+            'path': '/'.join(instance.getPhysicalPath()),
+            'field': field.getName(),
             'allowed_types': allowed_types,
             'target_id': target_id,
         })
 
     def solve_deferred(self):
-        # walk through self.deferred and link outstanding references
+        # walk through self.deferred once and link outstanding references.
+        # All types have been imported by now, so anything that cannot be
+        # found does not exist in the archive or the site.
         if self.deferred:
             print 'Attempting to solve %s deferred reference targets' % \
                   len(self.deferred)
-        nr_unsolved = [0, len(self.deferred)]
-        while nr_unsolved[-1] > nr_unsolved[-2]:
-            unsolved = []
-            for d in self.deferred:
-                src_obj = d['instance']
-                src_field = d['field']
-                target_id = d['target_id']
-                allowed_types = d['allowed_types']
-                catalog = d['catalog']
+        unsolved = []
+        for d in self.deferred:
+            src_obj = self.portal.unrestrictedTraverse(d['path'])
+            src_field = src_obj.schema[d['field']]
+            target_id = d['target_id']
+            allowed_types = d['allowed_types']
 
-                try:
-                    proxies = catalog(portal_type=allowed_types, id=target_id)
-                except:
-                    continue
-                if len(proxies) > 0:
-                    obj = proxies[0].getObject()
-                    if src_field.multiValued:
-                        value = src_field.get(src_obj)
-                        if obj.UID() not in value:
-                            value.append(obj.UID())
-                    else:
-                        value = obj.UID()
-                    src_field.set(src_obj, value)
+            uid = self.lookup(allowed_types, target_id)
+            if uid:
+                if src_field.multiValued:
+                    value = list(src_field.getRaw(src_obj, aslist=True))
+                    if uid not in value:
+                        value.append(uid)
                 else:
-                    unsolved.append(d)
-            self.deferred = unsolved
-            nr_unsolved.append(len(unsolved))
+                    value = uid
+                src_field.set(src_obj, value)
+                self.touch(src_obj)
+                self.metrics.add('objects')
+            else:
+                unsolved.append(d)
+        self.deferred = unsolved
         if self.deferred:
             print 'Failed to solve %s deferred targets:' % len(self.deferred)
             pprint.pprint(self.deferred)
+            if self.args.upsert:
+                self.forget_unsolved_hashes()
+
+    def forget_unsolved_hashes(self):
+        """Remove the upsert hashes of the fields whose references could not
+        be linked, and of their rows, so that the next upsert sets those
+        fields again instead of skipping the rows as unchanged.
+        """
+        for d in self.deferred:
+            src_obj = self.portal.unrestrictedTraverse(d['path'])
+            annotations = IAnnotations(src_obj)
+            if HASHES_KEY not in annotations:
+                continue
+            hashes = dict(annotations[HASHES_KEY])
+            hashes.pop(d['field'], None)
+            hashes.pop(ROW_HASH, None)
+            annotations[HASHES_KEY] = hashes
+
+    def dry_run(self):
+        """Check the archive against the site, without changing either.
+
+        Sheets are read once, in the order they would be imported.  Ids are
+        registered as their rows are read, as import_portal_type does, so
+        that a reference to an object which is imported later is counted
+        as one for solve_deferred, and one to an object which is neither in
+        the archive nor in the site is reported as unresolved.  Columns are
+        checked against the schemas of the site's types, parents against
+        the site and the archive, and file cells against the members of
+        the archive.  Exits with status 1 if there are problems.
+        """
+        start = time.time()
+        if self.args.inputfile == '-':
+            self.zf = StreamReader(sys.stdin)
+            for name in self.zf:
+                pass
+        else:
+            self.zf = zipfile.ZipFile(
+                self.args.inputfile, 'r', allowZip64=True)
+        manifest = {}
+        if 'manifest.json' in self.zf.NameToInfo:
+            manifest = json.loads(self.zf.read('manifest.json'))
+        self.read_manifest(manifest)
+        self.open_workbook()
+        # [(sheetname, instance_id, problem), ...]
+        self.problems = []
+        # References to objects not yet registered; see check_reference.
+        self.pending = []
+        # {sheetname: {'rows':, 'files':, 'file_bytes':}}
+        self.sheet_stats = OrderedDict()
+        # Archive members of the files to be set
+        self.members = set()
+        # {parent path: exists} and the paths of the archive's objects
+        self.parents = {}
+        self.paths = set()
+
+        if 'Tombstones' in self.wb:
+            for rowdict in self.wb.iter_dicts('Tombstones'):
+                instance_id = rowdict['path'].encode('utf-8').split('/')[-1]
+                self.get_registry(rowdict['portal_type']).pop(
+                    instance_id, None)
+        if self.includes_settings('Laboratory', 'bika_setup/laboratory'):
+            self.check_settings('Laboratory',
+                                self.portal.bika_setup.laboratory)
+        if self.includes_settings('BikaSetup', 'bika_setup'):
+            self.check_settings('BikaSetup', self.portal.bika_setup)
+        schemas = self.get_schemas()
+        pt = getToolByName(self.portal, 'portal_types')
+        portal_types = [portal_type for portal_type in export_types
+                        if portal_type in self.wb]
+        for portal_type in self.plan_import(portal_types):
+            if not self.is_included(portal_type):
+                continue
+            if portal_type not in pt or portal_type not in schemas:
+                self.problem(portal_type, None, 'not found in portal_types')
+                continue
+            self.check_sheet(portal_type, schemas[portal_type])
+        # Whatever is still missing once every sheet has been read cannot
+        # be solved by solve_deferred either.
+        nr_deferred = 0
+        for sheetname, instance_id, fieldname, allowed_types, target_id \
+                in self.pending:
+            if self.lookup(allowed_types, target_id):
+                nr_deferred += 1
+            else:
+                self.problem(sheetname, instance_id,
+                             '%s: no %s with id %r' % (
+                                 fieldname,
+                                 ' or '.join(allowed_types) or 'object',
+                                 target_id))
+        cycles = self.get_type_cycles(portal_types)
+        member_bytes = sum(self.zf.NameToInfo[name].file_size
+                           for name in self.members)
+        self.wb.close()
+        self.zf.close()
+        transaction.abort()
+
+        print 'Dry run of %s, checked in %.1f seconds' % (
+            self.args.inputfile, time.time() - start)
+        print '%-31s %9s %7s %10s' % ('sheet', 'rows', 'files', 'file MB')
+        for sheetname, stats in self.sheet_stats.items():
+            print '%-31s %9d %7d %10.1f' % (
+                sheetname, stats['rows'], stats['files'],
+                stats['file_bytes'] / 1e6)
+        file_bytes = sum(stats['file_bytes']
+                         for stats in self.sheet_stats.values())
+        print '%d rows; %.1f MB of files, of which %.1f MB are distinct' % (
+            sum(stats['rows'] for stats in self.sheet_stats.values()),
+            file_bytes / 1e6, member_bytes / 1e6)
+        for group in cycles:
+            print 'Cycle: %s' % ' -> '.join(group + group[:1])
+        print '%d references will be linked after the import' % nr_deferred
+        if self.problems:
+            print '%d problems:' % len(self.problems)
+            for sheetname, instance_id, problem in self.problems:
+                if instance_id is None:
+                    print '  %s: %s' % (sheetname, problem)
+                else:
+                    print '  %s %s: %s' % (sheetname, instance_id, problem)
+            sys.exit(1)
+        print 'No problems found'
+
+    def problem(self, sheetname, instance_id, problem):
+        self.problems.append((sheetname, instance_id, problem))
+
+    def check_settings(self, sheetname, instance):
+        """Check the (field, value) rows of the Laboratory or BikaSetup
+        sheet against the schema of instance.
+        """
+        stats = self.sheet_stats[sheetname] = {
+            'rows': 0, 'files': 0, 'file_bytes': 0}
+        schema = instance.schema
+        for row in self.wb.iter_rows(sheetname):
+            fieldname = row[0]
+            cellvalue = row[1] if len(row) > 1 else None
+            stats['rows'] += 1
+            field = schema.get(fieldname)
+            if field is None:
+                self.problem(sheetname, None,
+                             'unknown field %s' % fieldname)
+                continue
+            check = self.compile_check(field)
+            if check:
+                check(sheetname, instance.getId(), cellvalue)
+
+    def check_sheet(self, portal_type, schema):
+        """Check the rows of a portal_type's sheet, and register its ids.
+        """
+        stats = self.sheet_stats[portal_type] = {
+            'rows': 0, 'files': 0, 'file_bytes': 0}
+        rows = self.wb.iter_rows(portal_type)
+        keys = next(rows, [])
+        missing = [key for key in ('path', 'uid', 'id', 'title')
+                   if key not in keys]
+        if missing:
+            self.problem(portal_type, None,
+                         'missing columns %s' % ', '.join(missing))
+            return
+        self.indexes.set_working_set(self.get_index_sheets(schema, keys))
+        checks = []
+        for col, fieldname in enumerate(keys):
+            if fieldname in ('path', 'uid', 'id', 'title'):
+                continue
+            field = schema.get(fieldname)
+            if field is None:
+                self.problem(portal_type, None,
+                             'unknown field %s' % fieldname)
+                continue
+            check = self.compile_check(field)
+            if check:
+                checks.append((col, check))
+        path_col = keys.index('path')
+        uid_col = keys.index('uid')
+        id_col = keys.index('id')
+        registry = self.get_registry(portal_type)
+        for rownr, values in enumerate(rows):
+            if len(values) < len(keys):
+                values += [None] * (len(keys) - len(values))
+            if not values[id_col]:
+                self.problem(portal_type, None,
+                             'row %d has no id' % (rownr + 1))
+                continue
+            instance_id = values[id_col].encode('utf-8')
+            path = (values[path_col] or '').encode('utf-8').strip('/')
+            if not self.in_scope(portal_type, path, instance_id,
+                                 values[uid_col]):
+                continue
+            stats['rows'] += 1
+            if path not in self.parents:
+                self.parents[path] = path in self.paths or \
+                    self.portal.unrestrictedTraverse(path, None) is not None
+            if not self.parents[path]:
+                self.problem(portal_type, instance_id,
+                             'parent %s not found' % path)
+            self.paths.add('%s/%s' % (path, instance_id) if path
+                           else instance_id)
+            registry[instance_id] = values[uid_col] or instance_id
+            for col, check in checks:
+                check(portal_type, instance_id, values[col])
+
+    def compile_check(self, field):
+        """Return a function of (sheetname, instance_id, cell value) which
+        checks what the setter of field needs in order to set the value,
+        or None if it needs nothing.
+        """
+        fieldname = field.getName()
+        check = None
+        if isinstance(field, (RecordField, RecordsField)):
+            def check(sheetname, instance_id, value):
+                if value and value not in self.wb:
+                    self.problem(sheetname, instance_id,
+                                 '%s: sheet %s not found' % (
+                                     fieldname, value))
+        elif Field.IReferenceField.providedBy(field):
+            allowed_types = field.allowed_types
+            if isinstance(allowed_types, basestring):
+                allowed_types = [allowed_types]
+            allowed_types = list(allowed_types or [])
+            if field.multiValued:
+                relationship = field.relationship[:31]
+
+                def check(sheetname, instance_id, value):
+                    if relationship not in self.wb:
+                        return
+                    index = self.get_relationship_index(relationship)
+                    for target_id in index.get(instance_id) or []:
+                        self.check_reference(sheetname, instance_id,
+                                             fieldname, allowed_types,
+                                             target_id)
+            else:
+                def check(sheetname, instance_id, value):
+                    if value:
+                        self.check_reference(sheetname, instance_id,
+                                             fieldname, allowed_types, value)
+        elif Field.IFileField.providedBy(field) \
+                and not Field.ITextField.providedBy(field):
+            def check(sheetname, instance_id, value):
+                if value and isinstance(value, basestring):
+                    self.check_file(sheetname, instance_id, fieldname, value)
+        return check
+
+    def check_reference(self, sheetname, instance_id, fieldname,
+                        allowed_types, target_id):
+        """Count a reference which can be resolved when its row is
+        imported, or keep it for the end of the dry run.
+        """
+        if isinstance(target_id, unicode):
+            target_id = target_id.encode('utf-8')
+        if not self.lookup(allowed_types, target_id):
+            self.pending.append(
+                (sheetname, instance_id, fieldname, allowed_types, target_id))
+
+    def check_file(self, sheetname, instance_id, fieldname, value):
+        """Check that the member named in a file cell is in the archive,
+        and add its size to the sheet's file bytes.
+        """
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        arcname = value
+        if value.startswith('blobs/') and '|' in value:
+            arcname = value.split('|', 1)[0]
+        zinfo = self.zf.NameToInfo.get(arcname)
+        if zinfo is None:
+            self.problem(sheetname, instance_id,
+                         '%s: file %s not found' % (fieldname, arcname))
+            return
+        stats = self.sheet_stats[sheetname]
+        stats['files'] += 1
+        stats['file_bytes'] += zinfo.file_size
+        self.members.add(arcname)
 
 
 if __name__ == '__main__':
@@ -373,7 +1895,8 @@ if __name__ == '__main__':
         '-i',
         dest='inputfile',
         required=True,
-        help='input zip file, created by the export script.')
+        help='input zip file, created by the export script, or - to read'
+             ' it from stdin as it is exported.')
     parser.add_argument(
         '-u',
         dest='username',
@@ -396,7 +1919,131 @@ if __name__ == '__main__':
         action='append',
         help='If a new Plone site is created, this option may be used to'
              ' specify additional profiles to be activated.'),
+    parser.add_argument(
+        '--include-type',
+        dest='include_types',
+        action='append',
+        default=[],
+        metavar='PORTAL_TYPE',
+        help='Import only the rows of this portal_type, or the Laboratory or'
+             ' BikaSetup sheet.  May be repeated.')
+    parser.add_argument(
+        '--exclude-type',
+        dest='exclude_types',
+        action='append',
+        default=[],
+        metavar='PORTAL_TYPE',
+        help='Do not import the rows of this portal_type, or the Laboratory'
+             ' or BikaSetup sheet.  May be repeated.')
+    parser.add_argument(
+        '--client',
+        dest='clients',
+        action='append',
+        default=[],
+        metavar='UID',
+        help='Import only the client with this UID and its contents, and'
+             ' whatever --path selects.  May be repeated.')
+    parser.add_argument(
+        '--path',
+        dest='paths',
+        action='append',
+        default=[],
+        help='Import only the objects at or below this path, relative to'
+             ' the site root, and whatever --client selects.  May be'
+             ' repeated.')
+    parser.add_argument(
+        '--index-rows',
+        dest='index_rows',
+        type=int,
+        default=1000000,
+        help='Maximum number of lookup sheet rows to hold in memory at once,'
+             ' unless the type being imported uses more (default: 1000000)')
+    parser.add_argument(
+        '--prepare-threads',
+        dest='prepare_threads',
+        type=int,
+        default=2,
+        help='Number of threads which decode rows, look up records and'
+             ' extract files ahead of the thread that writes objects; 0'
+             ' does everything in that thread (default: 2)')
+    parser.add_argument(
+        '--prepare-rows',
+        dest='prepare_rows',
+        type=int,
+        default=1000,
+        help='Maximum number of rows read and prepared ahead of the thread'
+             ' that writes objects (default: 1000)')
+    parser.add_argument(
+        '--upsert',
+        dest='upsert',
+        action='store_true',
+        help='Update objects that already exist, found by their exported UID'
+             ' or by path and id, instead of creating them.  Only fields that'
+             ' changed since the previous upsert, or whose references it could'
+             ' not link, are set.')
+    parser.add_argument(
+        '--bulk',
+        dest='bulk',
+        action='store_true',
+        help='Do not catalog objects as they are created.  Instead, catalog'
+             ' only the imported objects once the import is complete, rather'
+             ' than rebuilding all catalogs.')
+    parser.add_argument(
+        '--index-batch',
+        dest='index_batch',
+        type=int,
+        default=1000,
+        help='In bulk mode, the number of objects cataloged between'
+             ' savepoints (default: 1000)')
+    parser.add_argument(
+        '--commit-every',
+        dest='commit_every',
+        type=int,
+        default=0,
+        help='Commit the transaction after this many objects have been'
+             ' imported (default: commit once, at the end)')
+    parser.add_argument(
+        '--commit-interval',
+        dest='commit_interval',
+        type=int,
+        default=0,
+        help='Commit the transaction when this many seconds have passed'
+             ' since the last commit (default: commit once, at the end)')
+    parser.add_argument(
+        '--checkpoint',
+        dest='checkpoint',
+        default='',
+        help='When committing in batches, record the last committed row in'
+             ' this file (default: INPUTFILE.checkpoint)')
+    parser.add_argument(
+        '--metrics',
+        dest='metrics',
+        default='',
+        help='Write the time, objects, catalog queries, file bytes and peak'
+             ' memory of each phase of the import to this JSON file.')
+    parser.add_argument(
+        '--profile',
+        dest='profile',
+        default='',
+        help='Profile each phase, and write the cProfile statistics of the'
+             ' slowest to this file.')
+    parser.add_argument(
+        '--dry-run',
+        dest='dry_run',
+        action='store_true',
+        help='Check the archive against the site, and report unresolved'
+             ' references, cycles between types, unknown fields, missing'
+             ' files, row counts and the size of the files to be imported,'
+             ' without changing anything.')
+    parser.add_argument(
+        '--resume',
+        dest='resume',
+        action='store_true',
+        help='Skip the rows recorded in the checkpoint file by an earlier,'
+             ' interrupted import.')
     args, unknown = parser.parse_known_args()
+    if args.checkpoint == '':
+        args.checkpoint = args.inputfile + '.checkpoint'
 
     main = Main(args)
     main()